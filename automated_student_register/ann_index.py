@@ -0,0 +1,125 @@
+"""
+Approximate nearest-neighbour index for large face galleries.
+An inverted-file (IVF) index: gallery rows are partitioned with spherical
+k-means and a query is only scored against the rows of the n_probe
+partitions whose centroids it is closest to. Raising n_probe trades
+latency for recall; n_probe equal to the number of lists is an exact scan.
+"""
+import os
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Partition assignments for the rows of a FaceGallery matrix.
+    The index only holds centroids and which list each student belongs to;
+    scoring goes back through the gallery so features are not duplicated.
+    """
+
+    def __init__(self, n_probe=8):
+        self.n_probe = n_probe
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assignments = {}
+        self.list_rows = []
+        self.trained_size = 0
+
+    def __len__(self):
+        return len(self.assignments)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def train(self, vectors, n_lists, iterations=8, seed=0):
+        """Spherical k-means over normalised gallery rows"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            counts = np.bincount(labels, minlength=n_lists)
+            # Re-seed empty partitions from random rows
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = sums / norms
+
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assignments = {}
+        self.trained_size = len(vectors)
+
+    def add(self, ids, vectors):
+        """Assign (or re-assign) students to their nearest partition"""
+        if not len(ids):
+            return
+        labels = np.argmax(np.asarray(vectors, dtype=np.float32) @ self.centroids.T, axis=1)
+        for student_id, label in zip(ids, labels):
+            self.assignments[student_id] = int(label)
+
+    def remove(self, ids):
+        """Forget students that left the gallery"""
+        for student_id in ids:
+            self.assignments.pop(student_id, None)
+
+    def bind(self, rows):
+        """
+        Resolve each partition's students to gallery matrix rows.
+        Must be called after every gallery rebuild, since rows shift.
+        """
+        members = [[] for _ in range(self.n_lists)]
+        for student_id, label in self.assignments.items():
+            if student_id in rows:
+                members[label].append(rows[student_id])
+        self.list_rows = [np.array(m, dtype=np.int64) for m in members]
+
+    def search(self, score_fn, queries, top_k, n_probe=None):
+        """
+        Approximate top_k rows for each prepared query.
+        score_fn(query, rows) scores a query against gallery rows, so the
+        gallery decides whether that uses full features or compact codes.
+        Returns a list of (row indices, scores) pairs, best first.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([self.list_rows[i] for i in lists])
+            if not len(rows):
+                results.append((rows, np.zeros(0, dtype=np.float32)))
+                continue
+            scores = score_fn(query, rows)
+            k = min(top_k, len(rows))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            results.append((rows[best], scores[best]))
+        return results
+
+    def save(self, path):
+        """Write centroids and assignments next to the feature store"""
+        ids = np.array(list(self.assignments), dtype=np.int64)
+        labels = np.array([self.assignments[i] for i in ids], dtype=np.int64)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, ids=ids, labels=labels,
+                 trained_size=self.trained_size)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, n_probe=8):
+        """Read an index written by save(), or None if it is missing or unreadable"""
+        try:
+            with np.load(path) as data:
+                index = cls(n_probe=n_probe)
+                index.centroids = data['centroids']
+                index.assignments = {int(i): int(label) for i, label in zip(data['ids'], data['labels'])}
+                index.trained_size = int(data['trained_size'])
+                return index
+        except (OSError, ValueError, KeyError):
+            return None
@@ -3,6 +3,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import cv2
 import datetime
+import json
 import os
 import numpy as np
 import subprocess
@@ -11,8 +12,14 @@ import time
 import traceback
 import signal
 import sys
-import tflite_runtime.interpreter as tflite
-from sklearn.metrics.pairwise import cosine_similarity
+from face_gallery import write_enrolment
+from recognizers import HistogramRecognizer, ColourHistogramRecognizer, TFLiteEmbeddingRecognizer, find_model_path
+from face_detection import AdaptiveDetector
+from detectors import load_detector
+from frame_ring import FrameRingReader
+from stream_hub import StreamHub, StreamProfile
+from stream_server import MJPEGServer
+from event_broker import EventBroker
 
 camera_service_process = None
 camera_lock = threading.Lock()
@@ -51,33 +58,203 @@ os.makedirs('student_faces', exist_ok=True)
 # Add this near the top of your app where other directories are created
 os.makedirs('static/current', exist_ok=True)
 
+# Recognition features computed by save_face are handed to camera_service.py here
+FEATURE_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'feature_store')
+ENROLMENT_DIR = os.path.join(FEATURE_STORE_DIR, 'enrolments')
+
 # Use app.app_context() to create tables
 with app.app_context():
     db.create_all()  # Create tables
 
+# Interpreter threads for the embedding model
+TFLITE_NUM_THREADS = 2
+
+# Frames published by camera_service.py through shared memory
+frame_ring = FrameRingReader()
+frame_ring_lock = threading.Lock()
+
+def camera_frame(last_key=None, want_frame=True, want_jpeg=False):
+    """
+    Newest frame from the camera service as (key, timestamp, BGR frame, jpeg).
+    Reads the shared-memory ring, falling back to static/current/frame.jpg when
+    the service publishes to disk instead. jpeg is (jpeg_profile, bytes) when
+    want_jpeg and the service encoded the frame for streaming; the BGR frame is
+    only copied out if want_frame or there is no such JPEG. frame and jpeg are
+    None if there is no frame, or it is the one identified by last_key.
+    """
+    with frame_ring_lock:
+        published = frame_ring.published()
+        if published >= 0:
+            if last_key and last_key[0] == 'ring' and last_key[1] == published:
+                if time.time() - last_key[2] <= frame_ring.stale_after:
+                    return last_key, last_key[2], None, None
+                # Nothing new for a while: the service stopped, or restarted with a new
+                # block this reader isn't attached to, so look for that and read again
+                frame_ring.reattach()
+            frame, info = frame_ring.read(want_frame=want_frame, want_jpeg=want_jpeg)
+            jpeg = (info['jpeg_profile'], info['jpeg']) if info and want_jpeg and info['jpeg'] else None
+            if info is not None and frame is None and jpeg is None:
+                # This frame wasn't encoded by the service, so copy out the pixels after all
+                frame, info = frame_ring.read()
+            if info is not None:
+                return ('ring', info['published'], info['timestamp']), info['timestamp'], frame, jpeg
+    
+    current_frame_path = 'static/current/frame.jpg'
+    if not os.path.exists(current_frame_path):
+        return None, 0, None, None
+    mod_time = os.path.getmtime(current_frame_path)
+    key = ('file', mod_time, mod_time)
+    if key == last_key:
+        return key, mod_time, None, None
+    return key, mod_time, cv2.imread(current_frame_path), None
+
+def read_camera_frame(max_age=5):
+    """Newest BGR frame from the camera service, or None if none is newer than max_age seconds"""
+    key, timestamp, frame, jpeg = camera_frame()
+    if frame is None or time.time() - timestamp >= max_age:
+        return None
+    return frame
+
+# Seconds a /get_detection_results?since= request waits for new results
+DETECTION_LONG_POLL = 25
+# Unchanged detections are re-announced this often so they still count as recent
+DETECTION_REFRESH = 10
+
+# Notified whenever the camera service publishes a frame or new detections;
+# stream producers and detection long-polls wait on this instead of polling files
+camera_events = threading.Condition()
+camera_state = {'frames': 0, 'detections': 0, 'detection': None}
+
+# Pushes detections, attendance inserts and service status to open dashboards.
+# Every open stream holds a Flask thread, so only EVENT_MAX_CLIENTS are served
+# at once; further dashboards get 503 and poll the JSON endpoints instead
+EVENT_MAX_CLIENTS = 20
+event_broker = EventBroker(max_clients=EVENT_MAX_CLIENTS)
+
+def detection_payload(detection, version):
+    """get_detection_results / detection event body for the current results"""
+    if not detection:
+        return {'status': 'no_data', 'message': 'No detection results available', 'version': version}
+    return {
+        'status': 'success',
+        'content': detection['content'],
+        'timestamp': datetime.datetime.fromtimestamp(detection['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+        # Recent means less than 30 seconds old
+        'is_recent': time.time() - detection['timestamp'] < 30,
+        'version': version
+    }
+
+def note_detections(names, timestamp, content=None):
+    """Record detection results and announce them if they changed (camera_events held)"""
+    detection = camera_state['detection']
+    if detection and detection['names'] == names and timestamp - detection['timestamp'] < DETECTION_REFRESH:
+        return False
+    if content is None:
+        stamp = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        content = f"Timestamp: {stamp}\nDetected students: {', '.join(names)}"
+    camera_state['detection'] = {'names': names, 'timestamp': timestamp, 'content': content}
+    camera_state['detections'] += 1
+    event_broker.publish('detection', detection_payload(camera_state['detection'], camera_state['detections']))
+    return True
+
+def attendance_payload(attendance_id, student_id, name, timestamp):
+    """One attendance row as the dashboard shows it"""
+    return {'attendance_id': attendance_id, 'id': student_id, 'name': name,
+            'time': timestamp.strftime('%H:%M:%S')}
+
+def watch_camera_frames():
+    """
+    Blocks on the frame ring's notifications and turns each publish into a
+    camera_events wakeup. Only if the service fell back to writing files are
+    their modification times polled, here in one place.
+    """
+    watcher = FrameRingReader()
+    published = -1
+    frame_mtime = detection_mtime = 0
+    timeout = 1.0
+    # Newest attendance row already announced, and the last service status announced
+    last_attendance = None
+    service_running = None
+    while True:
+        try:
+            current = watcher.wait(published, timeout=timeout)
+            changed = False
+            if current >= 0 and current != published:
+                _, info = watcher.read(want_frame=False)
+                if info is not None:
+                    names = sorted({face['name'] for face in info['meta'].get('faces', []) if face.get('name')})
+                    with camera_events:
+                        camera_state['frames'] += 1
+                        if names:
+                            note_detections(names, info['timestamp'])
+                        camera_events.notify_all()
+                    
+                    # Inserts made by the service since the last frame
+                    rows = info['meta'].get('attendance', [])
+                    if last_attendance is None:
+                        # Rows from before we started are already in the dashboards' snapshot
+                        last_attendance = max((row['attendance_id'] for row in rows), default=0)
+                    for row in rows:
+                        if row['attendance_id'] > last_attendance:
+                            last_attendance = row['attendance_id']
+                            timestamp = datetime.datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S')
+                            event_broker.publish('attendance', attendance_payload(
+                                row['attendance_id'], row['student_id'], row['name'], timestamp))
+            published = current
+            
+            running = camera_service_running()
+            if running != service_running:
+                service_running = running
+                event_broker.publish('status', {'status': 'running' if running else 'stopped'})
+            
+            if current < 0:
+                with camera_events:
+                    if os.path.exists('static/current/frame.jpg'):
+                        mod_time = os.path.getmtime('static/current/frame.jpg')
+                        if mod_time != frame_mtime:
+                            frame_mtime = mod_time
+                            camera_state['frames'] += 1
+                            changed = True
+                    if os.path.exists('static/current/detection_results.txt'):
+                        mod_time = os.path.getmtime('static/current/detection_results.txt')
+                        if mod_time != detection_mtime:
+                            detection_mtime = mod_time
+                            with open('static/current/detection_results.txt', 'r') as f:
+                                content = f.read()
+                            camera_state['detection'] = {'names': None, 'timestamp': mod_time, 'content': content}
+                            camera_state['detections'] += 1
+                            event_broker.publish('detection', detection_payload(camera_state['detection'],
+                                                                                camera_state['detections']))
+                            changed = True
+                    if changed:
+                        camera_events.notify_all()
+                # Frame files only change quickly while a service is writing them
+                timeout = 0.1 if time.time() - frame_mtime < 5 else 1.0
+            else:
+                timeout = 1.0
+        except Exception as e:
+            print(f"Error watching camera frames: {e}")
+            time.sleep(1)
+
+def wait_for_camera_frame(seen, timeout):
+    """Block until the camera service publishes a frame after seen; returns the new frame count"""
+    with camera_events:
+        camera_events.wait_for(lambda: camera_state['frames'] != seen, timeout)
+        return camera_state['frames']
+
 # Load facial recognition model
 def load_model():
     try:
-        # Try multiple possible model paths
-        possible_paths = [
-            'facial_recognition_model.tflite',  # Original path
-            'automated_student_register/models/facial_recognition_model.tflite',  # New path from error
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models/facial_recognition_model.tflite'),  # Absolute path
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'facial_recognition_model.tflite')  # Absolute path in current dir
-        ]
+        # Same search paths as the camera service
+        model_path = find_model_path(os.path.dirname(os.path.abspath(__file__)))
+        if model_path is None:
+            print("Error: Model not found, enrolments will only store histogram features")
+            return None
         
-        # Try each path
-        for model_path in possible_paths:
-            if os.path.exists(model_path):
-                print(f"Found model at: {model_path}")
-                interpreter = tflite.Interpreter(model_path=model_path)
-                interpreter.allocate_tensors()
-                print("Model loaded successfully")
-                return interpreter
-                
-        # If we get here, no model was found
-        print(f"Error: Model not found in any of these locations: {possible_paths}")
-        return None
+        print(f"Found model at: {model_path}")
+        recognizer = TFLiteEmbeddingRecognizer(model_path, num_threads=TFLITE_NUM_THREADS)
+        print("Model loaded successfully")
+        return recognizer
         
     except Exception as e:
         print(f"Error loading model: {e}")
@@ -86,6 +263,11 @@ def load_model():
 # Global variable for the model
 facial_recognition_model = load_model()
 
+# Every backend the camera service might run gets its features at enrolment time
+enrolment_recognizers = [HistogramRecognizer(), ColourHistogramRecognizer()]
+if facial_recognition_model:
+    enrolment_recognizers.append(facial_recognition_model)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
@@ -185,19 +367,12 @@ def save_face():
     else:
         # Case 2: No uploaded image, capture from camera service feed
         print("No uploaded image, using current frame from camera service")
-        current_frame_path = 'static/current/frame.jpg'
         
-        if not os.path.exists(current_frame_path):
-            return jsonify({"error": "Camera service not running. No current frame available."}), 400
-            
-        # Check if frame is recent
-        current_time = time.time()
-        mod_time = os.path.getmtime(current_frame_path)
-        if current_time - mod_time > 3:
-            return jsonify({"error": "Camera feed appears frozen. Please restart camera service."}), 400
-            
-        # Read the current frame
-        img = cv2.imread(current_frame_path)
+        # Must be recent - an old frame means the feed is frozen
+        img = read_camera_frame(max_age=3)
+        if img is None:
+            return jsonify({"error": "No current camera frame. Please start or restart the camera service."}), 400
+        
         # Convert BGR to RGB for processing
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         if img is None:
@@ -218,39 +393,13 @@ def save_face():
         # Convert to grayscale for face detection
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
-        # Load face detector
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        if face_cascade.empty():
-            # Try alternate paths
-            alternate_paths = [
-                '/usr/local/share/opencv4/haarcascades/haarcascade_frontalface_default.xml',
-                '/usr/share/opencv4/haarcascades/haarcascade_frontalface_default.xml'
-            ]
-            for path in alternate_paths:
-                if os.path.exists(path):
-                    face_cascade = cv2.CascadeClassifier(path)
-                    if not face_cascade.empty():
-                        break
-                        
-        if face_cascade.empty():
+        # Load face detector (once per process)
+        face_cascade = load_detector('haar', BASE_DIR)
+        if face_cascade is None:
             return jsonify({"error": "Could not load face detection model"}), 500
                         
-        # Detect faces with more permissive parameters
-        faces = face_cascade.detectMultiScale(
-            gray, 
-            scaleFactor=1.1, 
-            minNeighbors=3,
-            minSize=(30, 30)
-        )
-        
-        if len(faces) == 0:
-            # Try again with even more permissive parameters
-            faces = face_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.3, 
-                minNeighbors=2,
-                minSize=(20, 20)
-            )
+        # Single permissive pass - enrolment photos are posed, close-up faces
+        faces = AdaptiveDetector(face_cascade, downscale=1.0, min_neighbors=3, min_size=(20, 20)).detect(gray)
             
         if len(faces) == 0:
             return jsonify({"error": "No face detected in the image. Please try again with better lighting."}), 400
@@ -276,8 +425,13 @@ def save_face():
         else:
             # Just save the full image if no face is found (although this branch shouldn't be reached)
             # Convert RGB back to BGR for saving with cv2.imwrite
-            img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(image_path, img_bgr)
+            face_img = img
+            face_img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            cv2.imwrite(image_path, face_img_bgr)
+        
+        # Compute recognition features now so the camera service never decodes this photo
+        features = {recognizer.feature_kind: recognizer.extract(face_img_bgr)
+                    for recognizer in enrolment_recognizers}
         
         # Store the path in the database - used relative URL path for browser access
         rel_path = f'static/student_faces/{student_id}/face.jpg'
@@ -286,6 +440,13 @@ def save_face():
         if student:
             student.photo_path = rel_path
             db.session.commit()
+            
+            # Queue the features and tell a running camera service to hot-add them
+            write_enrolment(ENROLMENT_DIR, student.student_id, student.name, rel_path,
+                            os.path.getmtime(image_path), features)
+            with camera_lock:
+                if camera_service_process and camera_service_process.poll() is None:
+                    camera_service_process.send_signal(signal.SIGUSR1)
         
         print(f"Face saved to {image_path}")
         print(f"Database updated with path: {rel_path}")
@@ -425,169 +586,126 @@ def camera_service_status():
     try:
         with camera_lock:
             if camera_service_process and camera_service_process.poll() is None:
-                return jsonify({"status": "running"})
+                status = {"status": "running"}
+                # Per-stage queue depths written by the camera service
+                stats_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'current', 'pipeline.json')
+                try:
+                    with open(stats_path) as f:
+                        status["pipeline"] = json.load(f)
+                except (OSError, ValueError):
+                    pass
+                return jsonify(status)
             else:
                 return jsonify({"status": "stopped"})
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error: {str(e)}"})
 
+def camera_service_running():
+    with camera_lock:
+        return bool(camera_service_process and camera_service_process.poll() is None)
+
+def video_placeholder(service_running):
+    """Shown on /video_feed while there is no recent frame"""
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)  # Smaller frame for performance
+    if service_running:
+        cv2.putText(frame, "Camera feed not updating", (20, 120), 
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    else:
+        cv2.putText(frame, "Camera not running", (20, 120), 
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    return frame
+
+def capture_placeholder(service_running):
+    """Shown on /capture_feed while there is no recent frame"""
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    if service_running:
+        cv2.putText(frame, "Waiting for camera service...", (80, 240), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+    else:
+        cv2.putText(frame, "Camera service not running", (80, 240), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+    cv2.putText(frame, "Start camera service from the admin page", (60, 280), 
+               cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
+    return frame
+
+# Every viewer of a stream is sent the same encoded bytes; each new frame is
+# encoded once per stream that currently has viewers
+stream_hub = StreamHub(camera_frame, camera_service_running, wait=wait_for_camera_frame)
+# Resized to 640x480 at lower quality to reduce bandwidth. The camera service
+# already encodes frames at this profile, so they are forwarded as they are
+stream_hub.add_profile(StreamProfile('video', size=(640, 480), quality=70, max_age=5,
+                                     placeholder=video_placeholder, passthrough=True))
+# Full resolution with a "Capture Mode" overlay for the face capture page
+stream_hub.add_profile(StreamProfile('capture', quality=80, overlay="CAPTURE MODE", max_age=3,
+                                     placeholder=capture_placeholder))
+# Small, low-quality tiles for showing many rooms on one screen
+stream_hub.add_profile(StreamProfile('thumbnail', size=(160, 120), quality=50, max_age=5,
+                                     placeholder=video_placeholder))
+
+# Viewers are served by an asyncio server on its own port, so open dashboards
+# don't each hold a Flask worker thread. The feed routes redirect there and
+# only stream themselves if it can't be used.
+#
+# REMOTE VIEWERS: by default the server binds loopback, like app.run(), so only
+# browsers on this machine are redirected to it; every other viewer still holds
+# a Flask thread. To serve viewers on other machines, set STREAM_SERVER_HOST to
+# '0.0.0.0' (or the LAN address) - plain-HTTP requests are then redirected to
+# http://<the host they used>:STREAM_SERVER_PORT. Behind a reverse proxy, that
+# port isn't reachable: also set STREAM_SERVER_URL to the address the proxy
+# forwards to the MJPEG server, e.g. 'https://attendance.example.org/stream'.
+STREAM_SERVER_PORT = 8081
+STREAM_MAX_VIEWERS = 100
+STREAM_SERVER_HOST = '127.0.0.1'
+STREAM_SERVER_URL = None
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost')
+stream_server = MJPEGServer(stream_hub, {'/video_feed': 'video', '/capture_feed': 'capture'},
+                            host=STREAM_SERVER_HOST, port=STREAM_SERVER_PORT,
+                            max_viewers=STREAM_MAX_VIEWERS)
+stream_server_lock = threading.Lock()
+stream_server_started = False
+
+def stream_server_url():
+    """URL of this request on the MJPEG server (started on first use), or None"""
+    global stream_server_started
+    if STREAM_SERVER_URL:
+        base = STREAM_SERVER_URL.rstrip('/')
+    else:
+        host = request.host.rsplit(':', 1)[0] if not request.host.endswith(']') else request.host
+        if request.scheme != 'http' or 'X-Forwarded-Host' in request.headers:
+            return None  # Proxied or HTTPS pages can't use http://<host>:8081
+        if STREAM_SERVER_HOST in LOOPBACK_HOSTS and host not in LOOPBACK_HOSTS:
+            return None  # The browser is on another machine and can't reach a loopback server
+        base = f"http://{host}:{STREAM_SERVER_PORT}"
+    with stream_server_lock:
+        if not stream_server_started:
+            # Started here rather than at import, so only the process serving requests binds the port
+            stream_server_started = True
+            stream_server.start()
+    if not stream_server.running():
+        return None
+    return base + request.full_path.rstrip('?')
+
 @app.route('/video_feed')
 def video_feed():
-    def generate_frames():
-        last_frame_time = 0
-        no_frame_count = 0
-        
-        while True:
-            try:
-                current_time = time.time()
-                # Only process every 100ms to reduce CPU usage
-                if current_time - last_frame_time < 0.1:
-                    time.sleep(0.05)
-                    continue
-                    
-                last_frame_time = current_time
-                current_frame_path = 'static/current/frame.jpg'
-                
-                if os.path.exists(current_frame_path):
-                    # Get modification time
-                    mod_time = os.path.getmtime(current_frame_path)
-                    
-                    # Only use frame if it's recent (less than 5 seconds old)
-                    if current_time - mod_time < 5:
-                        # Read the current frame saved by the camera service
-                        frame = cv2.imread(current_frame_path)
-                        no_frame_count = 0  # Reset counter
-                        
-                        if frame is not None:
-                            # Convert BGR to RGB for correct color display
-                            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                            
-                            # Resize to reduce bandwidth if frame is large
-                            if frame.shape[0] > 480 or frame.shape[1] > 640:
-                                frame = cv2.resize(frame, (640, 480))
-                                
-                            # Convert frame to JPEG with lower quality for better performance
-                            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 70]
-                            ret, buffer = cv2.imencode('.jpg', frame, encode_param)
-                            frame_bytes = buffer.tobytes()
-                            
-                            yield (b'--frame\r\n'
-                                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                            continue
-                
-                # If we get here, either the file doesn't exist or frame is too old
-                no_frame_count += 1
-                
-                # Only create a new blank frame every 10 iterations to reduce CPU usage
-                if no_frame_count % 10 == 1:
-                    frame = np.zeros((240, 320, 3), dtype=np.uint8)  # Smaller frame for performance
-                    
-                    if os.path.exists(current_frame_path):
-                        cv2.putText(frame, "Camera feed not updating", (20, 120), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                    else:
-                        cv2.putText(frame, "Camera not running", (20, 120), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                    
-                    ret, buffer = cv2.imencode('.jpg', frame)
-                    frame_bytes = buffer.tobytes()
-                    
-                    yield (b'--frame\r\n'
-                        b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                    
-                time.sleep(0.1)  # Reduced sleep time
-                
-            except Exception as e:
-                print(f"Error in generate_frames: {e}")
-                time.sleep(0.5)
-    
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    """Live camera feed; ?profile= picks another stream profile, e.g. thumbnail"""
+    profile = request.args.get('profile', 'video')
+    if not stream_hub.has_profile(profile):
+        return jsonify({"error": f"Unknown stream profile: {profile}"}), 404
+    url = stream_server_url()
+    if url:
+        return redirect(url)
+    return Response(stream_hub.stream(profile), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/capture_feed')
 def capture_feed():
-    """Show camera feed from the running camera service for face capture page"""
-    def generate_frames():
-        print("Starting capture feed from camera service frames...")
-        last_frame_time = 0
-        no_frame_count = 0
-        
-        while True:
-            try:
-                current_time = time.time()
-                # Only process every 100ms to reduce CPU usage
-                if current_time - last_frame_time < 0.1:
-                    time.sleep(0.05)
-                    continue
-                    
-                last_frame_time = current_time
-                current_frame_path = 'static/current/frame.jpg'
-                
-                if os.path.exists(current_frame_path):
-                    # Get modification time
-                    mod_time = os.path.getmtime(current_frame_path)
-                    
-                    # Only use frame if it's recent (less than 3 seconds old)
-                    if current_time - mod_time < 3:
-                        # Read the current frame saved by the camera service
-                        frame = cv2.imread(current_frame_path)
-                        
-                        if frame is not None:
-                            # Convert BGR to RGB for correct color display
-                            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                            
-                            # Add a "Capture Mode" overlay to indicate we're in capture mode
-                            cv2.putText(frame, "CAPTURE MODE", (20, 30), 
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 0), 2)
-                            
-                            # Use lower quality encoding for performance
-                            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-                            ret, buffer = cv2.imencode('.jpg', frame, encode_param)
-                            if not ret:
-                                continue
-                                
-                            frame_bytes = buffer.tobytes()
-                            no_frame_count = 0  # Reset counter
-                            
-                            yield (b'--frame\r\n'
-                                  b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                            continue
-                
-                # If we get here, either the file doesn't exist or frame is too old
-                no_frame_count += 1
-                
-                # Only create a new blank frame every 5 iterations to reduce CPU usage
-                if no_frame_count % 5 == 1:
-                    # Create a message frame
-                    frame = np.zeros((480, 640, 3), dtype=np.uint8)
-                    
-                    # Check if camera service is running
-                    with camera_lock:
-                        service_running = camera_service_process and camera_service_process.poll() is None
-                    
-                    if service_running:
-                        cv2.putText(frame, "Waiting for camera service...", (80, 240), 
-                                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
-                        cv2.putText(frame, "Start camera service from the admin page", (60, 280), 
-                                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
-                    else:
-                        cv2.putText(frame, "Camera service not running", (80, 240), 
-                                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
-                        cv2.putText(frame, "Start camera service from the admin page", (60, 280), 
-                                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
-                    
-                    ret, buffer = cv2.imencode('.jpg', frame)
-                    frame_bytes = buffer.tobytes()
-                    
-                    yield (b'--frame\r\n'
-                          b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                
-                time.sleep(0.1)  # Small sleep to prevent high CPU usage
-                
-            except Exception as e:
-                print(f"Error in capture_feed: {e}")
-                time.sleep(0.5)  # Longer sleep on error
-    
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    """Show camera feed from the running camera service for face capture page; ?profile= as for video_feed"""
+    profile = request.args.get('profile', 'capture')
+    if not stream_hub.has_profile(profile):
+        return jsonify({"error": f"Unknown stream profile: {profile}"}), 404
+    url = stream_server_url()
+    if url:
+        return redirect(url)
+    return Response(stream_hub.stream(profile), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 def log_attendance(student_id):
     # Prevent duplicate logs within short timeframe
@@ -602,6 +720,8 @@ def log_attendance(student_id):
         db.session.commit()
         student = Student.query.get(student_id)
         print(f"Attendance logged for {student.name if student else 'Unknown'}")
+        event_broker.publish('attendance', attendance_payload(
+            new_attendance.attendance_id, student_id, student.name if student else None, new_attendance.timestamp))
 
 @app.route('/video')
 @login_required
@@ -632,75 +752,58 @@ def check_attendance():
 
 @app.route('/get_detection_results')
 def get_detection_results():
-    """API endpoint to get the latest detection results"""
+    """
+    API endpoint to get the latest detection results.
+    With ?since=<version> the request waits until results newer than that
+    version exist (or DETECTION_LONG_POLL seconds pass) before answering.
+    """
     try:
-        detection_file = 'static/current/detection_results.txt'
-        if os.path.exists(detection_file):
-            # Get file modification time
-            mod_time = os.path.getmtime(detection_file)
-            timestamp = datetime.datetime.fromtimestamp(mod_time).strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Check if file is recent (less than 30 seconds old)
-            time_diff = time.time() - mod_time
-            is_recent = time_diff < 30
-            
-            # Read the file contents
-            with open(detection_file, 'r') as f:
-                content = f.read()
-                
-            return jsonify({
-                'status': 'success',
-                'content': content,
-                'timestamp': timestamp,
-                'is_recent': is_recent
-            })
-        else:
-            return jsonify({
-                'status': 'no_data',
-                'message': 'No detection results available'
-            })
+        since = request.args.get('since', type=int)
+        with camera_events:
+            if since is not None:
+                camera_events.wait_for(lambda: camera_state['detections'] != since, DETECTION_LONG_POLL)
+            detection = camera_state['detection']
+            version = camera_state['detections']
+        
+        return jsonify(detection_payload(detection, version))
     except Exception as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
         })
     
+def todays_attendance():
+    """Today's attendance, newest first, one entry per student"""
+    # Get today's date at midnight
+    today_start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    # Query for today's attendance with student names
+    attendance_records = db.session.query(
+        Attendance, Student.name
+    ).join(
+        Student, Attendance.student_id == Student.student_id
+    ).filter(
+        Attendance.timestamp >= today_start
+    ).order_by(
+        Attendance.timestamp.desc()
+    ).all()
+    
+    # Get unique students (first appearance only)
+    unique_students = []
+    seen_ids = set()
+    for attendance, name in attendance_records:
+        if attendance.student_id not in seen_ids:
+            unique_students.append(attendance_payload(attendance.attendance_id, attendance.student_id,
+                                                      name, attendance.timestamp))
+            seen_ids.add(attendance.student_id)
+    return unique_students
+
 @app.route('/today_attendance')
 @login_required
 def today_attendance():
     """API endpoint to get today's attendance"""
     try:
-        # Get today's date at midnight
-        today_start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Query for today's attendance with student names
-        attendance_records = db.session.query(
-            Attendance, Student.name
-        ).join(
-            Student, Attendance.student_id == Student.student_id
-        ).filter(
-            Attendance.timestamp >= today_start
-        ).order_by(
-            Attendance.timestamp.desc()
-        ).all()
-        
-        # Format the results
-        students = []
-        for attendance, name in attendance_records:
-            students.append({
-                'id': attendance.student_id,
-                'name': name,
-                'time': attendance.timestamp.strftime('%H:%M:%S')
-            })
-        
-        # Get unique students (first appearance only)
-        unique_students = []
-        seen_ids = set()
-        for student in students:
-            if student['id'] not in seen_ids:
-                unique_students.append(student)
-                seen_ids.add(student['id'])
-        
+        unique_students = todays_attendance()
         return jsonify({
             'status': 'success',
             'total_count': len(unique_students),
@@ -712,6 +815,41 @@ def today_attendance():
             'message': str(e)
         })
 
+@app.route('/events')
+@login_required
+def events():
+    """
+    Server-sent events for the live dashboard: detection, attendance and
+    status events as they happen. A new connection first gets a snapshot of
+    the current state; a reconnecting browser is sent the events it missed.
+    """
+    if not event_broker.join():
+        return Response('Too many live dashboards, try again later', status=503,
+                        headers={'Retry-After': '30'}, mimetype='text/plain')
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    initial = []
+    if last_id is None or not event_broker.can_resume(last_id):
+        # Events published while the snapshot is built are still sent after it
+        last_id = event_broker.last_id()
+        try:
+            with camera_events:
+                detection = detection_payload(camera_state['detection'], camera_state['detections'])
+            students = todays_attendance()
+            status = 'running' if camera_service_running() else 'stopped'
+        except Exception:
+            event_broker.leave()
+            raise
+        initial.append(('snapshot', {
+            'status': status,
+            'detection': detection,
+            'attendance': {'total_count': len(students), 'students': students}
+        }))
+    response = Response(event_broker.stream(last_id, initial), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the client disconnects, even if the stream never started
+    response.call_on_close(event_broker.leave)
+    return response
+
 @app.route('/debug_camera')
 @login_required
 def debug_camera():
@@ -725,6 +863,8 @@ def debug_camera():
     # Check for camera static directory
     static_dir_exists = os.path.exists('static/current')
     frame_exists = os.path.exists('static/current/frame.jpg')
+    with frame_ring_lock:
+        ring_frame, ring_info = frame_ring.read()
     
     # Check if picamera2 is available
     picamera_available = False
@@ -749,11 +889,20 @@ def debug_camera():
         'video_devices': video_devices,
         'python_executable': sys.executable,
         'working_directory': os.getcwd(),
-        'app_directory': os.path.dirname(os.path.abspath(__file__))
+        'app_directory': os.path.dirname(os.path.abspath(__file__)),
+        'streams': stream_hub.stats(),
+        'stream_server': stream_server.stats() if stream_server.running() else None,
+        'events': event_broker.stats()
     }
     
+    # Shared-memory frames from the camera service
+    debug_info['frame_ring_available'] = ring_frame is not None
+    if ring_info:
+        debug_info['frame_ring_published'] = ring_info['published']
+        debug_info['frame_age_seconds'] = time.time() - ring_info['timestamp']
+    
     # Check if frame is recent
-    if frame_exists:
+    elif frame_exists:
         mod_time = os.path.getmtime('static/current/frame.jpg')
         current_time = time.time()
         debug_info['frame_age_seconds'] = current_time - mod_time
@@ -827,5 +976,8 @@ def test_webcam():
             'message': str(e)
         })
 
+# Turns frame ring notifications into stream wakeups, long-poll answers and dashboard events
+threading.Thread(target=watch_camera_frames, name='frame-watcher', daemon=True).start()
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -4,31 +4,55 @@ Camera service for automated student attendance monitoring.
 Uses picamera2 directly for more reliable face detection and recognition.
 """
 import os
-import time
-import sqlite3
 import signal
-import sys
-import cv2
-import numpy as np
-from datetime import datetime
-from picamera2 import Picamera2, Preview
 
 # Flag to control the main loop
 running = True
 
-# Create necessary directories
-os.makedirs('static/current', exist_ok=True)
-os.makedirs('student_faces', exist_ok=True)
+# Set by SIGUSR1 when the web app has enrolled a new face
+enrolment_pending = False
 
 def signal_handler(sig, frame):
     global running
     print("Stopping camera service...")
+    # The main loop sees this within half a second and runs the cleanup after it
     running = False
-    sys.exit(0)
 
-# Register signal handlers for graceful shutdown
+def enrolment_handler(sig, frame):
+    global enrolment_pending
+    enrolment_pending = True
+
+# Installed before the imports below, which take seconds on a Pi: save_face in
+# app.py may signal us as soon as we are started, and SIGUSR1's default action
+# would terminate the service
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
+signal.signal(signal.SIGUSR1, enrolment_handler)
+
+import json
+import time
+import threading
+import sqlite3
+import sys
+import cv2
+import numpy as np
+from collections import deque
+from datetime import datetime
+from picamera2 import Picamera2, Preview
+from face_gallery import FaceGallery, CascadeGallery, read_enrolments
+from recognizers import HistogramRecognizer, ColourHistogramRecognizer, create_recognizer
+from face_tracker import FaceTracker, iou_matrix
+from motion_gate import MotionGate
+from face_detection import (AdaptiveDetector, read_detector_config, tuned_backend, detector_settings,
+                            DETECTOR_CONFIG_FILENAME)
+from detectors import load_detector, select_backend
+from pipeline import Pipeline, DropOldestQueue
+from recognition_pool import RecognitionPool
+from frame_ring import FrameRingWriter
+
+# Create necessary directories
+os.makedirs('static/current', exist_ok=True)
+os.makedirs('student_faces', exist_ok=True)
 
 def log_message(message):
     """Log a message with timestamp"""
@@ -39,8 +63,98 @@ def log_message(message):
     with open("camera_service.log", "a") as f:
         f.write(f"[{timestamp}] {message}\n")
 
-def log_attendance(student_id, db_path='database.db'):
-    """Log attendance in the database"""
+# Base directory for resolving student photo paths
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Recognition backend for the main loop: 'histogram' (cheap), 'tflite' (embeddings)
+# or 'cascade' (histogram shortlist re-scored with embeddings)
+RECOGNIZER_BACKEND = 'histogram'
+TFLITE_NUM_THREADS = 4  # Interpreter threads for the embedding model
+CASCADE_CANDIDATES = 5  # Histogram shortlist size re-scored by the embedding model
+
+# Worker processes for feature extraction and matching (0 recognizes on the
+# pipeline's recognition thread). Workers map one shared copy of the gallery
+RECOGNITION_WORKERS = 0
+
+# Galleries at least this large are searched through an approximate (IVF) index.
+# ANN_PROBE is how many partitions each face is compared against: higher means
+# better recall but slower matching
+ANN_MIN_GALLERY = 2000
+ANN_PROBE = 8
+
+# Gallery feature compression: 'none', 'int8' (4x smaller) or 'binary' (32x smaller,
+# Hamming scan). Compressed galleries re-rank their best GALLERY_RERANK rows at full precision
+GALLERY_COMPRESSION = 'none'
+GALLERY_RERANK = 50
+
+# Face detector: 'haar', 'lbp', 'yunet' or 'auto' to benchmark them at startup and use
+# the fastest one that finds DETECTOR_RECALL_TARGET of the enrolled faces
+DETECTOR_BACKEND = 'auto'
+DETECTOR_RECALL_TARGET = 0.9
+
+# New faces are searched on a DETECTION_DOWNSCALE copy of the frame, plus one of
+# DETECTION_STRIPES full-resolution bands per tick for faces too small for it;
+# known faces are re-found in padded ROIs at full resolution. The cascade runs once
+# per tick, with scaleFactor/minNeighbors/minSize adapted from recent results
+DETECTION_DOWNSCALE = 0.5
+DETECTION_STRIPES = 4
+
+# Per-room parameters written by tune_detector.py override the defaults above
+DETECTOR_CONFIG = os.path.join(BASE_DIR, DETECTOR_CONFIG_FILENAME)
+
+# Detection only runs where the scene changed; a static room is re-checked with a
+# full-frame pass every MOTION_REFRESH seconds
+MOTION_GATING = True
+MOTION_THRESHOLD = 0.002  # Fraction of (downscaled) pixels that must change
+MOTION_REFRESH = 5.0
+
+# Reference features are computed once and refreshed only when a photo changes
+colour_gallery = FaceGallery(BASE_DIR, ColourHistogramRecognizer(), compression=GALLERY_COMPRESSION,
+                             rerank_size=GALLERY_RERANK, log=log_message)
+gallery_refresh_interval = 30  # Seconds between checks for changed student photos
+
+# Computed features are persisted here so restarts don't decode every photo
+FEATURE_STORE_DIR = os.path.join(BASE_DIR, 'feature_store')
+
+# Features computed by save_face wait here until we hot-add them
+ENROLMENT_DIR = os.path.join(FEATURE_STORE_DIR, 'enrolments')
+
+# Stage statistics are written here for the web app every PIPELINE_STATS_INTERVAL seconds
+PIPELINE_STATS_PATH = os.path.join(BASE_DIR, 'static', 'current', 'pipeline.json')
+PIPELINE_STATS_INTERVAL = 5
+
+# The live view is encoded once here, at the web app's 'video' stream profile,
+# and forwarded to viewers unchanged
+STREAM_SIZE = (640, 480)
+STREAM_QUALITY = 70
+STREAM_JPEG_BYTES = 256 * 1024  # Per ring slot; larger frames are encoded by the web app
+
+# Attendance inserts repeated in each frame's metadata for the web app
+ATTENDANCE_EVENT_HISTORY = 20
+
+def encode_stream_jpeg(frame):
+    """The frame as JPEG bytes at the stream profile, or None"""
+    if frame.shape[1] > STREAM_SIZE[0] or frame.shape[0] > STREAM_SIZE[1]:
+        frame = cv2.resize(frame, STREAM_SIZE)
+    ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), STREAM_QUALITY])
+    return buffer if ret else None
+
+def write_pipeline_stats(stats):
+    """Atomically replace the pipeline statistics file"""
+    try:
+        tmp_path = PIPELINE_STATS_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'time': time.time(), 'stages': stats}, f)
+        os.replace(tmp_path, PIPELINE_STATS_PATH)
+    except OSError as e:
+        log_message(f"Could not write pipeline stats: {e}")
+
+def log_attendance(student_id, db_path='database.db', on_insert=None):
+    """
+    Log attendance in the database.
+    on_insert, if given, is called with the new row (attendance_id,
+    student_id, name, timestamp) when one is inserted.
+    """
     try:
         # Connect to the database
         conn = sqlite3.connect(db_path)
@@ -60,6 +174,7 @@ def log_attendance(student_id, db_path='database.db'):
                 (student_id,)
             )
             conn.commit()
+            attendance_id = cursor.lastrowid
             
             # Get student name for logging
             cursor.execute("SELECT name FROM student WHERE student_id = ?", (student_id,))
@@ -68,6 +183,12 @@ def log_attendance(student_id, db_path='database.db'):
                 log_message(f"Logged attendance for {student_name[0]} (ID: {student_id})")
             else:
                 log_message(f"Logged attendance for student ID: {student_id}")
+            
+            if on_insert:
+                cursor.execute("SELECT timestamp FROM attendance WHERE attendance_id = ?", (attendance_id,))
+                on_insert({'attendance_id': attendance_id, 'student_id': student_id,
+                           'name': student_name[0] if student_name else None,
+                           'timestamp': cursor.fetchone()[0]})
         
         conn.close()
         return True
@@ -75,82 +196,31 @@ def log_attendance(student_id, db_path='database.db'):
         log_message(f"Database error: {e}")
         return False
 
-def recognize_student(face_img, conn):
+def recognize_student(face_img, gallery):
     """
-    Recognize a student face by comparing with stored faces
+    Recognize a student face by comparing with the cached colour histograms
     """
     try:
         # Add debug logging
         log_message(f"Starting face recognition on image of shape {face_img.shape}")
         
-        # Preprocess input face - resize to standard size
-        face_img_resized = cv2.resize(face_img, (128, 128))
+        threshold = gallery.recognizer.match_threshold
         
-        # Make sure it's in RGB for consistency with stored faces
-        if len(face_img_resized.shape) == 3 and face_img_resized.shape[2] == 3:
-            # Convert to RGB if it's not already (from BGR)
-            if not already_rgb:  # You'd need to determine this based on your pipeline
-                face_img_resized = cv2.cvtColor(face_img_resized, cv2.COLOR_BGR2RGB)
+        # Calculate histogram for input face (converted to RGB by the recognizer)
+        face_hist = gallery.recognizer.extract(face_img)
+        
+        log_message(f"Found {len(gallery)} students with photos to compare against")
+        
+        # Score against every student in one pass and log the closest candidates
+        candidates = gallery.match(face_hist, top_k=3)
+        for student_id, name, score in candidates:
+            log_message(f"Match score for student {name}: {score:.2f}")
         
         best_match_id = None
         best_match_name = None
         best_match_score = 0
-        threshold = 0.4  # Lower threshold for better matching (was 0.5)
-        
-        # Get the base directory for consistent path resolution
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        
-        # Calculate histogram for input face (in RGB)
-        face_hist = cv2.calcHist([face_img_resized], [0, 1, 2], None, [32, 32, 32], [0, 256, 0, 256, 0, 256])
-        cv2.normalize(face_hist, face_hist, 0, 1, cv2.NORM_MINMAX)
-        
-        # Get all students from database
-        cursor = conn.cursor()
-        cursor.execute("SELECT student_id, name, photo_path FROM student WHERE photo_path IS NOT NULL")
-        students = cursor.fetchall()
-        log_message(f"Found {len(students)} students with photos to compare against")
-        
-        for student_id, name, photo_path in students:
-            try:
-                # Get absolute path
-                if not os.path.isabs(photo_path):
-                    abs_photo_path = os.path.join(BASE_DIR, photo_path)
-                else:
-                    abs_photo_path = photo_path
-                    
-                # Skip if file doesn't exist
-                if not os.path.exists(abs_photo_path):
-                    log_message(f"Photo for student {name} not found at {abs_photo_path}")
-                    continue
-                    
-                # Load reference face
-                ref_face = cv2.imread(abs_photo_path)
-                if ref_face is None:
-                    log_message(f"Failed to load image for student {name}")
-                    continue
-                    
-                # Convert to RGB since that's what we're using for processing
-                ref_face = cv2.cvtColor(ref_face, cv2.COLOR_BGR2RGB)
-                
-                # Resize reference face to same size
-                ref_face_resized = cv2.resize(ref_face, (128, 128))
-                
-                # Calculate histogram for reference face
-                ref_hist = cv2.calcHist([ref_face_resized], [0, 1, 2], None, [32, 32, 32], [0, 256, 0, 256, 0, 256])
-                cv2.normalize(ref_hist, ref_hist, 0, 1, cv2.NORM_MINMAX)
-                
-                # Compare histograms
-                score = cv2.compareHist(face_hist, ref_hist, cv2.HISTCMP_CORREL)
-                
-                # Always log match scores for debugging
-                log_message(f"Match score for student {name}: {score:.2f}")
-                
-                if score > best_match_score and score > threshold:
-                    best_match_score = score
-                    best_match_id = student_id
-                    best_match_name = name
-            except Exception as e:
-                log_message(f"Error processing student {student_id}: {e}")
+        if candidates and candidates[0][2] > threshold:
+            best_match_id, best_match_name, best_match_score = candidates[0]
         
         if best_match_id:
             log_message(f"Best match: {best_match_name} (ID: {best_match_id}) with score {best_match_score:.2f}")
@@ -184,39 +254,17 @@ def process_frame(frame_path):
         # Convert to grayscale for face detection
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
-        # Attempt to load the face cascade
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        if face_cascade.empty():
-            log_message("Error: Face cascade is empty - checking alternate paths")
-            # Try alternate installation paths
-            alternate_paths = [
-                '/usr/local/share/opencv4/haarcascades/haarcascade_frontalface_default.xml',
-                '/usr/share/opencv4/haarcascades/haarcascade_frontalface_default.xml'
-            ]
-            for path in alternate_paths:
-                if os.path.exists(path):
-                    log_message(f"Trying alternate cascade path: {path}")
-                    face_cascade = cv2.CascadeClassifier(path)
-                    if not face_cascade.empty():
-                        log_message("Successfully loaded cascade from alternate path")
-                        break
-        
-        # Try with more permissive parameters
-        faces = face_cascade.detectMultiScale(
-            gray, 
-            scaleFactor=1.1, 
-            minNeighbors=4,
-            minSize=(30, 30)
-        )
+        # Shared with the rest of this process - only loaded once
+        backend = DETECTOR_BACKEND
+        if backend == 'auto':
+            backend = tuned_backend(read_detector_config(DETECTOR_CONFIG, log=log_message)) or 'haar'
+        face_cascade = load_detector(backend, BASE_DIR, log=log_message)
+        if face_cascade is None:
+            log_message("Error: No face detector available")
+            return False
         
-        if len(faces) == 0:
-            # Try again with more permissive parameters
-            faces = face_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.2, 
-                minNeighbors=3,
-                minSize=(30, 30)
-            )
+        # One pass with the same parameters the live loop starts from
+        faces = AdaptiveDetector(face_cascade, downscale=1.0).detect(gray)
         
         if len(faces) == 0:
             log_message("No faces detected")
@@ -227,6 +275,7 @@ def process_frame(frame_path):
         
         # Connect to the database for student recognition
         conn = sqlite3.connect('database.db')
+        colour_gallery.refresh(conn)
         
         # Process detected faces
         students_detected = []
@@ -242,7 +291,7 @@ def process_frame(frame_path):
             cv2.imwrite(face_path, face_img)
             
             # Try to recognize the student
-            student_id, name = recognize_student(face_img, conn)
+            student_id, name = recognize_student(face_img, colour_gallery)
             
             if student_id:
                 # Log attendance for recognized student
@@ -284,70 +333,68 @@ def process_frame(frame_path):
         log_message(f"Error processing frame: {e}")
         return False
 
-def recognize_face(face_img, conn):
+def recognize_face(face_img, gallery):
+    """
+    Face recognition against the cached gallery.
+    """
+    return recognize_faces([face_img], gallery)[0]
+
+def recognize_faces(face_imgs, gallery):
+    """
+    Recognize every face crop from a frame in one batch.
+    Returns a (student_id, name, score) tuple or None for each crop, in order.
+    """
+    threshold = gallery.recognizer.match_threshold  # Minimum similarity threshold
+    
+    matches = []
+    for candidates in score_faces(face_imgs, gallery):
+        if candidates and candidates[0][2] > threshold:
+            matches.append(candidates[0])
+        else:
+            matches.append(None)
+    return matches
+
+def score_faces(face_imgs, gallery, top_k=3):
     """
-    Face recognition based on histogram comparison.
+    Score every face crop from a frame against the gallery in one batch.
+    The gallery's recognizer computes features for all crops as one array
+    (a single invoke() for the embedding model) and they are scored in a
+    single matrix product. Returns the top_k (student_id, name, score)
+    candidates for each crop, best first.
     """
     try:
-        # Get a list of all students
-        cursor = conn.cursor()
-        cursor.execute("SELECT student_id, name, photo_path FROM student WHERE photo_path IS NOT NULL")
-        students = cursor.fetchall()
-        
-        if not students:
+        if not len(gallery):
             log_message("No students with photos found in database")
-            return None
-        
-        best_match = None
-        best_score = 0
-        threshold = 0.5  # Minimum similarity threshold
+            return [[] for _ in face_imgs]
         
-        # Get base directory
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        results = gallery.match_faces(face_imgs, top_k=top_k)
+        for i, candidates in enumerate(results):
+            for student_id, name, score in candidates:
+                log_message(f"Face {i} match score for {name}: {score:.2f}")
         
-        # Resize for consistency
-        face_img_resized = cv2.resize(face_img, (100, 100))
-        face_hist = cv2.calcHist([face_img_resized], [0], None, [256], [0, 256])
-        cv2.normalize(face_hist, face_hist, 0, 1, cv2.NORM_MINMAX)
-        
-        for student_id, name, photo_path in students:
-            # Resolve the relative path to absolute path
-            if os.path.isabs(photo_path):
-                abs_photo_path = photo_path
-            else:
-                abs_photo_path = os.path.join(BASE_DIR, photo_path)
-            
-            # Check if the file exists
-            if not os.path.exists(abs_photo_path):
-                log_message(f"Warning: Photo file not found for student {student_id}: {abs_photo_path}")
-                continue
-                
-            # Load the student's reference face
-            ref_face = cv2.imread(abs_photo_path, cv2.IMREAD_GRAYSCALE)
-            if ref_face is None:
-                log_message(f"Warning: Could not read photo file for student {student_id}: {abs_photo_path}")
-                continue
-            
-            # Resize for consistency
-            ref_face_resized = cv2.resize(ref_face, (100, 100))
-            ref_hist = cv2.calcHist([ref_face_resized], [0], None, [256], [0, 256])
-            cv2.normalize(ref_hist, ref_hist, 0, 1, cv2.NORM_MINMAX)
-            
-            # Compare histograms
-            score = cv2.compareHist(face_hist, ref_hist, cv2.HISTCMP_CORREL)
-            log_message(f"Match score for {name}: {score:.2f}")
-            
-            if score > best_score and score > threshold:
-                best_score = score
-                best_match = (student_id, name, score)
-        
-        return best_match
+        return results
     except Exception as e:
         log_message(f"Error in face recognition: {e}")
-        return None
+        return [[] for _ in face_imgs]
+
+def create_gallery(backend):
+    """Reference gallery for 'histogram', 'tflite' or 'cascade' recognition"""
+    def gallery_for(recognizer):
+        return FaceGallery(BASE_DIR, recognizer, index_min_size=ANN_MIN_GALLERY, index_probe=ANN_PROBE,
+                           compression=GALLERY_COMPRESSION, rerank_size=GALLERY_RERANK, log=log_message)
+    
+    if backend == 'cascade':
+        recognizer = create_recognizer('tflite', BASE_DIR, TFLITE_NUM_THREADS, log=log_message)
+        if isinstance(recognizer, HistogramRecognizer):
+            # No embedding model - a cascade would just be histograms twice
+            return gallery_for(recognizer)
+        return CascadeGallery(gallery_for(HistogramRecognizer()), gallery_for(recognizer),
+                              candidates=CASCADE_CANDIDATES, log=log_message)
+    return gallery_for(create_recognizer(backend, BASE_DIR, TFLITE_NUM_THREADS, log=log_message))
 
 def main():
     """Main function to run the camera service"""
+    global enrolment_pending
     log_message("Starting camera monitoring service")
     
     try:
@@ -360,138 +407,331 @@ def main():
         # Allow camera to warm up
         time.sleep(2)
         
-        # Load face detector
-        try:
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            if face_cascade.empty():
-                log_message("Error: Face cascade is empty - checking alternate paths")
-                # Try alternate installation paths
-                alternate_paths = [
-                    '/usr/local/share/opencv4/haarcascades/haarcascade_frontalface_default.xml',
-                    '/usr/share/opencv4/haarcascades/haarcascade_frontalface_default.xml'
-                ]
-                for path in alternate_paths:
-                    if os.path.exists(path):
-                        log_message(f"Trying alternate cascade path: {path}")
-                        face_cascade = cv2.CascadeClassifier(path)
-                        if not face_cascade.empty():
-                            log_message("Successfully loaded cascade from alternate path")
-                            break
-                
-                if face_cascade.empty():
-                    log_message("Fatal error: Could not load face cascade classifier")
-                    return
-        except Exception as e:
-            log_message(f"Error loading face cascade: {e}")
+        # Load face detector - with 'auto', the backend tune_detector.py tuned for this
+        # room if there is a config, otherwise benchmarked on a real frame
+        detector_config = read_detector_config(DETECTOR_CONFIG, log=log_message)
+        backend = DETECTOR_BACKEND
+        if backend == 'auto' and tuned_backend(detector_config):
+            backend = tuned_backend(detector_config)
+            face_cascade = load_detector(backend, BASE_DIR, log=log_message)
+            if face_cascade is None:
+                backend = 'auto'
+        if backend == 'auto':
+            probe = cv2.cvtColor(cv2.cvtColor(picam2.capture_array(), cv2.COLOR_RGB2BGR), cv2.COLOR_BGR2GRAY)
+            backend, face_cascade = select_backend(BASE_DIR, probe, recall_target=DETECTOR_RECALL_TARGET,
+                                                   log=log_message)
+        elif backend == DETECTOR_BACKEND:
+            face_cascade = load_detector(backend, BASE_DIR, log=log_message)
+        
+        if face_cascade is None:
+            log_message("Fatal error: Could not load a face detector")
             return
         
+        settings = {'downscale': DETECTION_DOWNSCALE, 'fine_stripes': DETECTION_STRIPES}
+        # Tuned parameters only make sense for the backend they were tuned on
+        if detector_config and tuned_backend(detector_config) != backend:
+            log_message(f"Ignoring detector settings tuned for {tuned_backend(detector_config)}, "
+                        f"using the {backend} detector")
+        elif detector_config:
+            tuned = detector_settings(detector_config)
+            log_message(f"Using detector settings tuned for {backend}: {tuned}")
+            settings.update(tuned)
+        detector = AdaptiveDetector(face_cascade, **settings)
+        detection_params = detector.params
+        
         # Create a connection to the database
         conn = sqlite3.connect('database.db', check_same_thread=False)
         
+        # Reference gallery for the configured recognition backend
+        gallery = create_gallery(RECOGNIZER_BACKEND)
+        recognizer = gallery.recognizer
+        
+        # Map in the saved features and any enrolments made while we were stopped,
+        # then decode only photos that changed since
+        gallery.load(FEATURE_STORE_DIR)
+        changed = gallery.apply_enrolments(read_enrolments(ENROLMENT_DIR, log=log_message))
+        if gallery.refresh(conn) or changed:
+            gallery.save(FEATURE_STORE_DIR)
+        last_gallery_refresh = time.time()
+        
+        # Optionally extract and score faces in worker processes sharing the gallery matrix
+        recognition_pool = None
+        if RECOGNITION_WORKERS:
+            if isinstance(gallery, CascadeGallery):
+                log_message("Recognition workers don't support the cascade backend, recognizing in-process")
+            else:
+                recognition_pool = RecognitionPool(gallery.feature_kind, BASE_DIR, workers=RECOGNITION_WORKERS,
+                                                   log=log_message)
+                recognition_pool.publish(gallery)
+        
+        # Tracks faces between detection ticks; known faces are re-verified every 10s.
+        # A student must be the top match in 3 of 5 samples before attendance is committed
+        tracker = FaceTracker(iou_threshold=0.3, max_age=2.0, reverify_interval=10.0,
+                              window_size=5, min_hits=3, vote_threshold=recognizer.match_threshold)
+        
+        # Skips detection on static scenes
+        motion_gate = None
+        if MOTION_GATING:
+            motion_gate = MotionGate(motion_fraction=MOTION_THRESHOLD, refresh_interval=MOTION_REFRESH)
+        
+        # When each student was last committed, so re-acquired tracks skip the database
+        attendance_committed = {}
+        attendance_cooldown = 60  # Matches the duplicate window in log_attendance
+        # Recent inserts ride along with every published frame, so the web app
+        # can push them to dashboards without querying the database
+        attendance_events = deque(maxlen=ATTENDANCE_EVENT_HISTORY)
+        
         # Create a blank initial frame
         blank_frame = np.zeros((720, 1280, 3), dtype=np.uint8)
         cv2.putText(blank_frame, "Camera starting...", (50, 360), 
                     cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        cv2.imwrite('static/current/frame.jpg', blank_frame)
         
-        # Main loop
+        # Frames go to the web app through shared memory; frame.jpg is only
+        # written if the ring can't be created
+        frame_ring = None
+        try:
+            frame_ring = FrameRingWriter(blank_frame.shape, jpeg_size=STREAM_JPEG_BYTES,
+                                         jpeg_profile=STREAM_SIZE + (STREAM_QUALITY,))
+            frame_ring.write(blank_frame, 0, time.time(), jpeg=encode_stream_jpeg(blank_frame))
+        except OSError as e:
+            log_message(f"Could not create shared frame buffer, publishing frame.jpg instead: {e}")
+            cv2.imwrite('static/current/frame.jpg', blank_frame)
+        
+        # The loop runs as pipelined stages on their own threads:
+        #   capture -> detect -> recognize -> attendance
+        #                     \-> publish
+        # Each queue is small and drops its oldest item when full, so a slow
+        # stage costs stale frames rather than stalling capture
         fps_limit = 5  # limit to 5 frames per second
         frame_interval = 1.0 / fps_limit
         detection_interval = 0.5  # Run face detection every 0.5 seconds
         last_detection_time = 0
-        
-        while running:
-            try:
-                loop_start = time.time()
-                
-                # Capture frame
-                frame = picam2.capture_array()
-                
-                # Convert to BGR (OpenCV format)
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                
-                # Make a copy for processing
-                display_frame = frame.copy()
+        frame_id = 0
+        
+        # The tracker is shared by detection and recognition, the gallery by
+        # recognition and the periodic refresh below
+        tracker_lock = threading.Lock()
+        gallery_lock = threading.Lock()
+        
+        def release_tracks(job):
+            # A dropped recognition job must not leave its tracks waiting forever
+            with tracker_lock:
+                for track in job['tracks']:
+                    track.pending = False
+        
+        detect_queue = DropOldestQueue(2)
+        recognize_queue = DropOldestQueue(2, on_drop=release_tracks)
+        attendance_queue = DropOldestQueue(64)
+        publish_queue = DropOldestQueue(2)
+        
+        def capture():
+            """Grab a frame, convert it to BGR (OpenCV format) and pace to fps_limit"""
+            nonlocal frame_id
+            loop_start = time.time()
+            frame = cv2.cvtColor(picam2.capture_array(), cv2.COLOR_RGB2BGR)
+            frame_id += 1
+            detect_queue.put({'id': frame_id, 'time': loop_start, 'frame': frame})
+            time.sleep(max(0, frame_interval - (time.time() - loop_start)))
+        
+        def detect(packet):
+            """Detect and track faces on detection ticks; queue recognition and publishing"""
+            nonlocal last_detection_time, detection_params
+            current_time = packet['time']
+            frame = packet['frame']
+            
+            # Run face detection at specified interval, but only where the scene changed
+            if current_time - last_detection_time >= detection_interval:
+                last_detection_time = current_time
                 
                 # Convert to grayscale for face detection
                 gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
                 
-                # Run face detection at specified interval
-                current_time = time.time()
-                if current_time - last_detection_time >= detection_interval:
-                    last_detection_time = current_time
-                    
-                    # Detect faces with multiple parameter combinations for better accuracy
-                    faces = []
-                    for scale in [1.1, 1.2]:
-                        for min_neighbors in [4, 5]:
-                            detected_faces = face_cascade.detectMultiScale(
-                                gray, 
-                                scaleFactor=scale, 
-                                minNeighbors=min_neighbors,
-                                minSize=(30, 30)
-                            )
-                            
-                            if len(detected_faces) > 0:
-                                faces = detected_faces
-                                break
-                        
-                        if len(faces) > 0:
-                            break
+                if motion_gate:
+                    run_detection, regions = motion_gate.check(gray, current_time)
+                else:
+                    run_detection, regions = True, None
+                
+                with tracker_lock:
+                    # Faces outside the changed area have not moved - keep their tracks alive
+                    if not run_detection or regions is not None:
+                        tracker.hold(current_time, regions)
                     
-                    # Process detected faces
+                    # Re-find tracked faces near where they were, plus new faces in the searched area
+                    known = [track.box for track in tracker.tracks]
+                    if regions is not None:
+                        known = [box for box in known if regions and iou_matrix([box], regions).any()]
+                
+                if run_detection:
+                    faces = detector.detect(gray, known, regions)
+                    if detector.params != detection_params:
+                        detection_params = detector.params
+                        log_message(f"Detection parameters changed: {detector.stats()}")
                     if len(faces) > 0:
                         log_message(f"Detected {len(faces)} faces")
-                        
-                        for i, (x, y, w, h) in enumerate(faces):
-                            # Draw rectangle around face
-                            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                            
-                            # Extract face for recognition
-                            face_img = gray[y:y+h, x:x+w]
-                            
-                            # Save detected face for debugging
-                            face_path = f'static/current/face_{i}.jpg'
-                            cv2.imwrite(face_path, face_img)
-                            
-                            # Recognize the face
-                            match = recognize_face(face_img, conn)
-                            
-                            if match:
-                                student_id, name, score = match
-                                # Log attendance
-                                log_attendance(student_id)
-                                
-                                # Add name label above face
-                                label = f"{name} ({score:.2f})"
-                                cv2.putText(display_frame, label, (x, y-10), 
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                            else:
-                                # Unknown person
-                                cv2.putText(display_frame, "Unknown", (x, y-10), 
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                    else:
-                        cv2.putText(display_frame, "No faces detected", (50, 50), 
-                                  cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                
-                # Add timestamp
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                cv2.putText(display_frame, timestamp, (10, display_frame.shape[0] - 10), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+                    
+                    # Follow faces across ticks so each person is recognized once
+                    with tracker_lock:
+                        tracks = tracker.update(faces, current_time)
+                        due = tracker.due_for_recognition(tracks, current_time)
+                        for track in due:
+                            track.pending = True
+                    
+                    if due:
+                        # Extract faces for recognition (colour for embedding models)
+                        source = frame if recognizer.needs_colour else gray
+                        face_imgs = [source[y:y+h, x:x+w] for x, y, w, h in (track.box for track in due)]
+                        recognize_queue.put({'time': current_time, 'tracks': due, 'face_imgs': face_imgs})
+            
+            with tracker_lock:
+                overlays = [(track.box, track.name if track.student_id else None, track.score)
+                            for track in tracker.tracks]
+            publish_queue.put({'id': packet['id'], 'time': current_time, 'frame': frame, 'overlays': overlays})
+        
+        def commit_evidence(job, results):
+            """Accumulate one batch of recognition results on the job's tracks"""
+            with tracker_lock:
+                for track, candidates in zip(job['tracks'], results):
+                    track.pending = False
+                    if not tracker.add_evidence(track, candidates, job['time']):
+                        continue
+                    
+                    # Identity just stabilised - commit attendance once
+                    log_message(f"Track {track.track_id} committed to {track.name} "
+                                f"(mean {track.score:.2f}, evidence {track.evidence[track.student_id]:.2f})")
+                    attendance_queue.put((track.student_id, job['time']))
+        
+        def pooled_results(job):
+            def done(results):
+                for i, candidates in enumerate(results):
+                    for student_id, name, score in candidates:
+                        log_message(f"Face {i} match score for {name}: {score:.2f}")
+                commit_evidence(job, results)
+            return done
+        
+        def recognize(job):
+            """Score new and re-verified faces in one batch and accumulate the evidence on each track"""
+            for i, face_img in enumerate(job['face_imgs']):
+                # Save detected face for debugging
+                cv2.imwrite(f'static/current/face_{i}.jpg', face_img)
+            
+            if recognition_pool:
+                # Blocks while the workers are saturated, so this stage's queue drops old jobs
+                try:
+                    recognition_pool.submit(job['face_imgs'], pooled_results(job))
+                except Exception:
+                    # e.g. BrokenProcessPool - the callback will never run for this job
+                    release_tracks(job)
+                    raise
+                return
+            
+            with gallery_lock:
+                results = score_faces(job['face_imgs'], gallery)
+            commit_evidence(job, results)
+        
+        def write_attendance(item):
+            """Database writes stay off the detection and recognition threads"""
+            student_id, committed_at = item
+            last_logged = attendance_committed.get(student_id, 0)
+            if committed_at - last_logged >= attendance_cooldown:
+                log_attendance(student_id, on_insert=attendance_events.append)
+                attendance_committed[student_id] = committed_at
+        
+        def publish(packet):
+            """Draw the current tracks and save the frame for the web app"""
+            # Draw on a copy - face crops for recognition may still reference the frame
+            display_frame = packet['frame'].copy()
+            
+            for (x, y, w, h), name, score in packet['overlays']:
+                # Draw rectangle around face
+                cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
                 
-                # Save the processed frame for the web app to use
+                if name:
+                    # Add name label above face
+                    label = f"{name} ({score:.2f})"
+                    cv2.putText(display_frame, label, (x, y-10), 
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                else:
+                    # Unknown person
+                    cv2.putText(display_frame, "Unknown", (x, y-10), 
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+            
+            if not packet['overlays']:
+                cv2.putText(display_frame, "No faces detected", (50, 50), 
+                          cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+            
+            # Add timestamp
+            timestamp = datetime.fromtimestamp(packet['time']).strftime("%Y-%m-%d %H:%M:%S")
+            cv2.putText(display_frame, timestamp, (10, display_frame.shape[0] - 10), 
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+            
+            # Hand the processed frame and its detections to the web app
+            if frame_ring:
+                faces = [{'box': [int(v) for v in box], 'name': name, 'score': round(float(score), 3)}
+                         for box, name, score in packet['overlays']]
+                frame_ring.write(display_frame, packet['id'], packet['time'],
+                                 {'faces': faces, 'attendance': list(attendance_events)},
+                                 jpeg=encode_stream_jpeg(display_frame))
+            else:
                 cv2.imwrite('static/current/frame.jpg', display_frame)
+        
+        pipeline = Pipeline(log=log_message)
+        pipeline.add('capture', capture)
+        pipeline.add('detect', detect, detect_queue)
+        pipeline.add('recognize', recognize, recognize_queue)
+        pipeline.add('attendance', write_attendance, attendance_queue)
+        pipeline.add('publish', publish, publish_queue)
+        pipeline.start()
+        
+        last_stats = 0
+        last_stats_log = time.time()
+        while running:
+            try:
+                time.sleep(0.5)
+                current_time = time.time()
+                
+                # Hot-add faces enrolled through the web app
+                if enrolment_pending:
+                    enrolment_pending = False
+                    enrolments = read_enrolments(ENROLMENT_DIR, log=log_message)
+                    with gallery_lock:
+                        if gallery.apply_enrolments(enrolments):
+                            gallery.save(FEATURE_STORE_DIR)
+                            if recognition_pool:
+                                recognition_pool.publish(gallery)
+                
+                # Pick up new or changed student photos
+                if current_time - last_gallery_refresh >= gallery_refresh_interval:
+                    last_gallery_refresh = current_time
+                    enrolments = read_enrolments(ENROLMENT_DIR, log=log_message)
+                    with gallery_lock:
+                        changed = gallery.apply_enrolments(enrolments)
+                        if gallery.refresh(conn) or changed:
+                            gallery.save(FEATURE_STORE_DIR)
+                            if recognition_pool:
+                                recognition_pool.publish(gallery)
                 
-                # Calculate remaining time to maintain frame rate
-                processing_time = time.time() - loop_start
-                sleep_time = max(0, frame_interval - processing_time)
-                time.sleep(sleep_time)
+                # Per-stage queue depths for the web app, and the log once a minute
+                if current_time - last_stats >= PIPELINE_STATS_INTERVAL:
+                    last_stats = current_time
+                    stats = pipeline.stats()
+                    write_pipeline_stats(stats)
+                    if current_time - last_stats_log >= 60:
+                        last_stats_log = current_time
+                        log_message("Pipeline: " + ", ".join(
+                            f"{name} {entry.get('queue_depth', '-')}/{entry.get('queue_size', '-')} "
+                            f"({entry['mean_ms']}ms, {entry.get('dropped', 0)} dropped)"
+                            for name, entry in stats.items()))
                 
             except Exception as e:
                 log_message(f"Error in main loop: {e}")
                 time.sleep(1)  # Wait before continuing
         
         # Cleanup
+        pipeline.stop()
+        if recognition_pool:
+            recognition_pool.shutdown()
+        if frame_ring:
+            frame_ring.close()
         picam2.stop()
         conn.close()
         log_message("Camera service stopped")
@@ -0,0 +1,209 @@
+"""
+Face detector backends.
+Every backend exposes the CascadeClassifier detectMultiScale() call, so the
+pyramid/adaptive detection in face_detection.py works unchanged on top of any
+of them:
+  - 'haar'  : haarcascade_frontalface_default.xml (the original detector)
+  - 'lbp'   : lbpcascade_frontalface_improved.xml, several times faster than Haar
+  - 'yunet' : OpenCV's YuNet CNN (cv2.FaceDetectorYN), most robust to pose and light
+Backends are loaded once per process and shared between threads.
+select_backend() benchmarks the available ones on this machine and picks the
+fastest that finds enough of the enrolled faces.
+"""
+import os
+import glob
+import time
+import threading
+import cv2
+import numpy as np
+
+YUNET_FILENAME = 'face_detection_yunet_2023mar.onnx'
+
+CASCADE_FILES = {
+    'haar': ('haarcascades', 'haarcascade_frontalface_default.xml'),
+    'lbp': ('lbpcascades', 'lbpcascade_frontalface_improved.xml'),
+}
+
+# Backends select_backend() benchmarks by default
+DETECTOR_BACKENDS = ('yunet', 'lbp', 'haar')
+
+# Backends already loaded in this process
+_loaded = {}
+
+
+def cascade_paths(backend, base_dir):
+    """Places a cascade file may be installed, most specific first"""
+    folder, filename = CASCADE_FILES[backend]
+    data_dir = os.path.dirname(os.path.normpath(cv2.data.haarcascades))
+    return [
+        os.path.join(base_dir, 'models', filename),
+        os.path.join(cv2.data.haarcascades, filename),
+        os.path.join(data_dir, folder, filename),
+        os.path.join('/usr/local/share/opencv4', folder, filename),
+        os.path.join('/usr/share/opencv4', folder, filename),
+    ]
+
+
+class CascadeDetector:
+    """Haar or LBP cascade classifier"""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.classifier = cv2.CascadeClassifier(path)
+
+    def empty(self):
+        return self.classifier.empty()
+
+    def detectMultiScale(self, img, **kwargs):
+        return self.classifier.detectMultiScale(img, **kwargs)
+
+
+class YuNetDetector:
+    """
+    YuNet face detector behind the cascade interface.
+    scaleFactor and minNeighbors have no meaning for a CNN and are ignored;
+    minSize/maxSize filter the boxes it returns. The model holds its input
+    size, so calls from different threads are serialised.
+    """
+
+    def __init__(self, path, score_threshold=0.7, nms_threshold=0.3, top_k=50):
+        self.name = 'yunet'
+        self.path = path
+        self.model = cv2.FaceDetectorYN.create(path, "", (320, 320), score_threshold, nms_threshold, top_k)
+        self.input_size = (320, 320)
+        self.lock = threading.Lock()
+
+    def empty(self):
+        return self.model is None
+
+    def detectMultiScale(self, img, minSize=(0, 0), maxSize=None, **kwargs):
+        if len(img.shape) == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        size = (img.shape[1], img.shape[0])
+        with self.lock:
+            if size != self.input_size:
+                self.model.setInputSize(size)
+                self.input_size = size
+            _, detections = self.model.detect(img)
+        if detections is None:
+            return []
+
+        faces = []
+        for x, y, w, h in detections[:, :4]:
+            if w < minSize[0] or h < minSize[1]:
+                continue
+            if maxSize and (w > maxSize[0] or h > maxSize[1]):
+                continue
+            faces.append((int(x), int(y), int(w), int(h)))
+        return faces
+
+
+def load_detector(backend, base_dir, log=print):
+    """
+    The named backend, loaded once per process.
+    Returns None if its model file is missing or cannot be loaded.
+    """
+    if backend in _loaded:
+        return _loaded[backend]
+
+    detector = None
+    try:
+        if backend in CASCADE_FILES:
+            for path in cascade_paths(backend, base_dir):
+                if os.path.exists(path):
+                    detector = CascadeDetector(backend, path)
+                    if not detector.empty():
+                        break
+                    log(f"Could not load {backend} cascade from {path}")
+                    detector = None
+        elif backend == 'yunet':
+            if not hasattr(cv2, 'FaceDetectorYN'):
+                log("This OpenCV build has no FaceDetectorYN")
+            else:
+                for path in (os.path.join(base_dir, 'models', YUNET_FILENAME), os.path.join(base_dir, YUNET_FILENAME)):
+                    if os.path.exists(path):
+                        detector = YuNetDetector(path)
+                        break
+        else:
+            log(f"Unknown detector backend: {backend}")
+    except Exception as e:
+        log(f"Error loading {backend} detector: {e}")
+        detector = None
+
+    if detector is None:
+        log(f"{backend} detector not available")
+    else:
+        log(f"Loaded {backend} detector from {detector.path}")
+    _loaded[backend] = detector
+    return detector
+
+
+def sample_faces(base_dir, limit=20, face_width=80):
+    """
+    Grey test images built from enrolled face photos: each photo is shrunk to
+    roughly classroom size and placed on a plain canvas with room around it.
+    """
+    paths = sorted(glob.glob(os.path.join(base_dir, 'static', 'student_faces', '*', '*.jpg')))
+    samples = []
+    for path in paths[:limit]:
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        height = max(1, int(img.shape[0] * face_width / float(img.shape[1])))
+        face = cv2.resize(img, (face_width, height), interpolation=cv2.INTER_AREA)
+        canvas = np.full((height * 2 + 40, face_width * 3), int(face.mean()), dtype=np.uint8)
+        top, left = (canvas.shape[0] - height) // 2, face_width
+        canvas[top:top + height, left:left + face_width] = face
+        samples.append(canvas)
+    return samples
+
+
+def benchmark(detector, frame, samples, repeats=3):
+    """Returns (recall on sample faces, ms per full frame) for one backend"""
+    params = {'scaleFactor': 1.1, 'minNeighbors': 4, 'minSize': (30, 30)}
+    detector.detectMultiScale(frame, **params)  # Warm-up (YuNet allocates on first call)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        detector.detectMultiScale(frame, **params)
+    ms = (time.perf_counter() - start) * 1000 / repeats
+
+    hits = sum(1 for sample in samples if len(detector.detectMultiScale(sample, **params)) > 0)
+    recall = hits / float(len(samples))
+    return recall, ms
+
+
+def select_backend(base_dir, frame, backends=DETECTOR_BACKENDS, recall_target=0.9, log=print):
+    """
+    Benchmark every loadable backend on a real camera frame and the enrolled
+    faces, and return (name, detector) for the fastest one that reaches
+    recall_target. Falls back to the most accurate backend if none does.
+    """
+    samples = sample_faces(base_dir)
+    if not samples:
+        # Speed alone would always pick the least accurate backend
+        log("No enrolled faces to benchmark recall against, using the haar detector")
+        return 'haar', load_detector('haar', base_dir, log=log)
+
+    results = []
+    for backend in backends:
+        detector = load_detector(backend, base_dir, log=log)
+        if detector is None:
+            continue
+        try:
+            recall, ms = benchmark(detector, frame, samples)
+        except Exception as e:
+            log(f"Benchmark failed for {backend} detector: {e}")
+            continue
+        log(f"Detector {backend}: recall {recall:.2f} on {len(samples)} faces, {ms:.1f} ms per frame")
+        results.append((backend, detector, recall, ms))
+
+    if not results:
+        return None, None
+    meeting = [r for r in results if r[2] >= recall_target]
+    if meeting:
+        backend, detector, recall, ms = min(meeting, key=lambda r: r[3])
+    else:
+        backend, detector, recall, ms = max(results, key=lambda r: (r[2], -r[3]))
+    log(f"Selected {backend} detector")
+    return backend, detector
@@ -0,0 +1,92 @@
+"""
+Server-sent events for the live dashboard.
+Detections, attendance inserts and camera service status changes are pushed
+to every open dashboard as they happen, instead of each page polling three
+endpoints on timers. Recent events are kept, so a browser that reconnects
+(EventSource does so by itself, sending Last-Event-ID) is sent what it missed.
+
+Each open stream holds a web server thread for as long as the page is open,
+so at most max_clients streams are served at once. A route calls join()
+before streaming and leave() when the response closes; dashboards turned
+away fall back to polling.
+"""
+import json
+import threading
+from collections import deque
+
+
+def sse_message(event, data, event_id=None):
+    """One event in text/event-stream format"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventBroker:
+    """Keeps the last history events and fans new ones out to every stream"""
+
+    def __init__(self, history=100, keepalive=15.0, max_clients=20):
+        self.events = deque(maxlen=history)
+        # Comment lines sent this often keep proxies from closing idle streams
+        self.keepalive = keepalive
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.max_clients = max_clients
+        self.clients = 0
+        self.rejected = 0
+
+    def publish(self, event, data):
+        with self.condition:
+            self.events.append((self.next_id, event, json.dumps(data)))
+            self.next_id += 1
+            self.condition.notify_all()
+
+    def last_id(self):
+        """Id of the newest event, 0 if none were published yet"""
+        with self.condition:
+            return self.next_id - 1
+
+    def can_resume(self, last_id):
+        """True if every event after last_id is still in the history"""
+        with self.condition:
+            oldest = self.events[0][0] if self.events else self.next_id
+            return oldest - 1 <= last_id < self.next_id
+
+    def join(self):
+        """Reserve a stream for a new client; False if max_clients are already open"""
+        with self.condition:
+            if self.clients >= self.max_clients:
+                self.rejected += 1
+                return False
+            self.clients += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.clients -= 1
+
+    def stats(self):
+        with self.condition:
+            return {'clients': self.clients, 'max_clients': self.max_clients, 'rejected': self.rejected}
+
+    def stream(self, last_id, initial=()):
+        """
+        Generator of event-stream text: the initial (event, data) pairs, then
+        every event published after last_id, until the client disconnects.
+        """
+        yield 'retry: 3000\n\n'
+        for event, data in initial:
+            yield sse_message(event, json.dumps(data))
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.next_id - 1 > last_id, timeout=self.keepalive)
+                pending = [entry for entry in self.events if entry[0] > last_id]
+            if not pending:
+                yield ': keepalive\n\n'
+                continue
+            for event_id, event, data in pending:
+                yield sse_message(event, data, event_id)
+            last_id = pending[-1][0]
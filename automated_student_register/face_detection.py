@@ -0,0 +1,283 @@
+"""
+Face detection for the camera service.
+Rather than running the cascade over the full 1280x720 frame at every scale,
+each pass combines three cheaper searches:
+  - a coarse pass on a downscaled copy of the frame for medium and large faces
+  - a fine pass at full resolution limited to small faces, over one horizontal
+    stripe of the frame per tick, so distant faces are still found within a
+    few ticks without paying for the whole frame every time
+  - full-resolution passes in padded ROIs around faces that are already tracked
+Boxes from all three are mapped back to full-resolution coordinates and merged.
+
+AdaptiveDetector runs that search once per tick and tunes the cascade
+parameters from recent hit rates and face sizes, instead of re-running the
+cascade with progressively more permissive parameters when nothing is found.
+"""
+import json
+import time
+from collections import deque
+import cv2
+import numpy as np
+from face_tracker import iou_matrix
+
+# Smallest window the frontal face cascades can detect
+CASCADE_WINDOW = 24
+
+# Parameters chosen by tune_detector.py for this room, next to the app
+DETECTOR_CONFIG_FILENAME = 'detector_config.json'
+
+
+def read_detector_config(path, log=print):
+    """The config written by tune_detector.py, or {} when there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log(f"Ignoring unreadable detector config {path}: {e}")
+        return {}
+
+
+def tuned_backend(config):
+    """Detector backend a config was tuned for, None without a config"""
+    if not config:
+        return None
+    # tune_detector.py tunes the haar cascade unless told otherwise
+    return config.get('backend', 'haar')
+
+
+def detector_settings(config):
+    """
+    AdaptiveDetector keyword arguments from a tune_detector.py config.
+    Returns {} for an empty config, so the built-in defaults apply.
+    """
+    settings = {}
+    if 'downscale' in config:
+        settings['downscale'] = float(config['downscale'])
+    if 'scale_factor' in config:
+        # The tuned scale is used while faces are present; idle passes stay at least as coarse
+        settings['busy_scale'] = float(config['scale_factor'])
+        settings['idle_scale'] = max(float(config['scale_factor']), 1.2)
+    if 'min_neighbors' in config:
+        settings['min_neighbors'] = int(config['min_neighbors'])
+        settings['max_neighbors'] = max(int(config['min_neighbors']) + 2, 6)
+    if 'min_size' in config:
+        settings['min_size'] = (int(config['min_size']), int(config['min_size']))
+    return settings
+
+
+def suppress_duplicates(boxes, iou_threshold=0.3):
+    """Drop boxes that overlap a larger box, keeping one box per face"""
+    if not len(boxes):
+        return []
+    boxes = sorted((tuple(int(v) for v in box) for box in boxes), key=lambda b: -b[2] * b[3])
+    overlap = iou_matrix(boxes, boxes)
+    kept = []
+    for i in range(len(boxes)):
+        if all(overlap[i, j] < iou_threshold for j in kept):
+            kept.append(i)
+    return [boxes[i] for i in kept]
+
+
+def clip_box(box, frame_w, frame_h):
+    """Clip an (x, y, w, h) box to the frame"""
+    x, y, w, h = box
+    x0, y0 = max(0, int(x)), max(0, int(y))
+    x1, y1 = min(frame_w, int(x + w)), min(frame_h, int(y + h))
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+class PyramidDetector:
+    """
+    Runs the cascade on a downscaled frame, one full-resolution small-face
+    stripe and ROIs around known faces, instead of one full-resolution pass.
+    """
+
+    def __init__(self, face_cascade, downscale=0.5, scale_factor=1.1, min_neighbors=4,
+                 min_size=(30, 30), fine_stripes=4, roi_padding=0.5):
+        self.face_cascade = face_cascade
+        self.downscale = downscale
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = tuple(min_size)
+        # Smallest face the ROI searches around known faces look for; new-face
+        # searches always use min_size, so distant faces are never hidden
+        self.roi_min_size = tuple(min_size)
+        # Number of ticks it takes the fine pass to cover the whole frame
+        self.fine_stripes = fine_stripes
+        # ROIs around known faces are grown by this fraction of the face size
+        self.roi_padding = roi_padding
+        self.stripe = 0
+
+    @property
+    def coarse_min_face(self):
+        """Smallest face (in full-resolution pixels) the coarse pass can find"""
+        return int(np.ceil(CASCADE_WINDOW / self.downscale))
+
+    def cascade(self, img, min_size, max_size=None):
+        if img.shape[0] < min_size[1] or img.shape[1] < min_size[0]:
+            return []
+        kwargs = {'scaleFactor': self.scale_factor, 'minNeighbors': self.min_neighbors,
+                  'minSize': tuple(int(v) for v in min_size)}
+        if max_size:
+            kwargs['maxSize'] = tuple(int(v) for v in max_size)
+        return self.face_cascade.detectMultiScale(img, **kwargs)
+
+    def coarse(self, small, area):
+        """Medium and large faces inside a full-resolution area, searched on the small frame"""
+        x, y, w, h = area
+        s = self.downscale
+        sx, sy = int(x * s), int(y * s)
+        roi = small[sy:sy + int(np.ceil(h * s)), sx:sx + int(np.ceil(w * s))]
+        min_size = (max(CASCADE_WINDOW, self.min_size[0] * s), max(CASCADE_WINDOW, self.min_size[1] * s))
+        return [((fx + sx) / s, (fy + sy) / s, fw / s, fh / s)
+                for fx, fy, fw, fh in self.cascade(roi, min_size)]
+
+    def fine(self, gray, area):
+        """Faces too small for the coarse pass, searched at full resolution"""
+        limit = self.coarse_min_face + 4
+        if self.downscale >= 1 or limit <= max(self.min_size):
+            return []
+        x, y, w, h = area
+        roi = gray[y:y + h, x:x + w]
+        return [(fx + x, fy + y, fw, fh) for fx, fy, fw, fh in self.cascade(roi, self.min_size, (limit, limit))]
+
+    def next_stripe(self, frame_w, frame_h):
+        """Full-width band for this tick's fine pass, overlapping its neighbours by one small face"""
+        band = int(np.ceil(frame_h / float(self.fine_stripes)))
+        overlap = self.coarse_min_face + 4
+        y0 = self.stripe * band
+        self.stripe = (self.stripe + 1) % self.fine_stripes
+        return clip_box((0, y0 - overlap, frame_w, band + 2 * overlap), frame_w, frame_h)
+
+    def around(self, gray, box):
+        """Full-resolution search in a padded ROI around a known face, at sizes close to it"""
+        frame_h, frame_w = gray.shape[:2]
+        x, y, w, h = box
+        pad = int(self.roi_padding * max(w, h))
+        rx, ry, rw, rh = clip_box((x - pad, y - pad, w + 2 * pad, h + 2 * pad), frame_w, frame_h)
+        roi = gray[ry:ry + rh, rx:rx + rw]
+        # Never so high that the tracked face itself is skipped
+        min_size = (max(self.min_size[0], min(max(self.roi_min_size[0], int(w * 0.6)), int(w * 0.9))),
+                    max(self.min_size[1], min(max(self.roi_min_size[1], int(h * 0.6)), int(h * 0.9))))
+        max_size = (int(w * 1.6) + 1, int(h * 1.6) + 1)
+        return [(fx + rx, fy + ry, fw, fh) for fx, fy, fw, fh in self.cascade(roi, min_size, max_size)]
+
+    def detect(self, gray, known_boxes=(), regions=None):
+        """
+        Full-resolution (x, y, w, h) face boxes.
+        known_boxes are faces already being tracked; regions limits the search for
+        new faces to changed areas of the frame (None searches the whole frame).
+        """
+        frame_h, frame_w = gray.shape[:2]
+        small = gray
+        if self.downscale < 1:
+            small = cv2.resize(gray, (int(frame_w * self.downscale), int(frame_h * self.downscale)),
+                               interpolation=cv2.INTER_AREA)
+
+        faces = []
+        if regions is None:
+            faces.extend(self.coarse(small, (0, 0, frame_w, frame_h)))
+            faces.extend(self.fine(gray, self.next_stripe(frame_w, frame_h)))
+        else:
+            # Changed regions are small, so they get the whole small-face search at once
+            for region in regions:
+                faces.extend(self.coarse(small, region))
+                faces.extend(self.fine(gray, region))
+
+        for box in known_boxes:
+            faces.extend(self.around(gray, box))
+
+        return [clip_box(box, frame_w, frame_h) for box in suppress_duplicates(faces)]
+
+
+class AdaptiveDetector(PyramidDetector):
+    """
+    One detection pass per call, with parameters adapted between passes:
+      - scaleFactor is coarser (cheaper) while the recent hit rate is low, and
+        finer while faces are present so their boxes stay accurate
+      - minSize of the searches around known faces follows the smallest faces
+        seen recently, so a room of nearby faces skips the many small scales
+        there; searches for new faces always go down to the floor, so one
+        nearby face doesn't hide smaller, more distant ones
+      - minNeighbors is raised while detections are transient (not seen in the
+        previous pass, typically false positives) and relaxed when they persist
+    The current parameters and per-pass timings are exposed through params and
+    stats() for logging.
+    """
+
+    def __init__(self, face_cascade, downscale=0.5, min_neighbors=4, min_size=(30, 30),
+                 fine_stripes=4, roi_padding=0.5, busy_scale=1.1, idle_scale=1.2,
+                 idle_hit_rate=0.2, max_neighbors=6, max_min_size=60, history=20):
+        super().__init__(face_cascade, downscale=downscale, scale_factor=busy_scale,
+                         min_neighbors=min_neighbors, min_size=min_size,
+                         fine_stripes=fine_stripes, roi_padding=roi_padding)
+        self.busy_scale = busy_scale
+        self.idle_scale = idle_scale
+        self.idle_hit_rate = idle_hit_rate
+        self.base_neighbors = min_neighbors
+        self.max_neighbors = max_neighbors
+        self.min_size_floor = tuple(min_size)
+        self.max_min_size = max_min_size
+        # Whether each recent pass found a face, and what fraction of its faces were new
+        self.hits = deque(maxlen=history)
+        self.transient = deque(maxlen=history)
+        self.sizes = deque(maxlen=history * 4)
+        # Milliseconds per pass
+        self.timings = deque(maxlen=history)
+        self.previous = []
+
+    @property
+    def params(self):
+        """Cascade parameters the next pass will use"""
+        return {'scale_factor': self.scale_factor, 'min_neighbors': self.min_neighbors,
+                'min_size': self.min_size, 'roi_min_size': self.roi_min_size}
+
+    @property
+    def hit_rate(self):
+        return sum(self.hits) / float(len(self.hits)) if self.hits else 0.0
+
+    def stats(self):
+        """Current parameters plus hit rate and pass timings"""
+        stats = dict(self.params)
+        stats['hit_rate'] = round(self.hit_rate, 2)
+        stats['last_ms'] = round(self.timings[-1], 1) if self.timings else 0.0
+        stats['mean_ms'] = round(sum(self.timings) / len(self.timings), 1) if self.timings else 0.0
+        return stats
+
+    def detect(self, gray, known_boxes=(), regions=None):
+        start = time.perf_counter()
+        faces = super().detect(gray, known_boxes, regions)
+        self.timings.append((time.perf_counter() - start) * 1000)
+        self.observe(faces)
+        self.adapt()
+        return faces
+
+    def observe(self, faces):
+        """Record the outcome of a pass"""
+        self.hits.append(bool(len(faces)))
+        self.sizes.extend(min(w, h) for x, y, w, h in faces)
+        if len(faces) and len(self.previous):
+            overlap = iou_matrix(faces, self.previous)
+            self.transient.append(float((overlap.max(axis=1) < 0.3).mean()))
+        self.previous = list(faces)
+
+    def adapt(self):
+        """Pick the parameters for the next pass from recent outcomes"""
+        busy = self.hit_rate >= self.idle_hit_rate
+        self.scale_factor = self.busy_scale if busy else self.idle_scale
+
+        if busy and self.sizes:
+            smallest = int(0.7 * np.percentile(self.sizes, 10))
+            side = max(min(smallest, self.max_min_size), *self.min_size_floor)
+            self.roi_min_size = (side, side)
+        else:
+            self.roi_min_size = self.min_size_floor
+
+        if self.transient:
+            churn = sum(self.transient) / len(self.transient)
+            if churn > 0.5:
+                self.min_neighbors = min(self.min_neighbors + 1, self.max_neighbors)
+            elif churn < 0.25:
+                self.min_neighbors = max(self.min_neighbors - 1, self.base_neighbors)
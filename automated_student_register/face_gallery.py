@@ -0,0 +1,566 @@
+"""
+In-memory gallery of reference face features for the camera service.
+Reference photos are decoded once and only reloaded when a student's
+photo_path or the photo file's modification time changes. Computed features
+can be saved to a feature store so a restart maps them straight back in.
+"""
+import os
+import json
+import hashlib
+import cv2
+import numpy as np
+from recognizers import HistogramRecognizer
+from ann_index import IVFIndex
+from quantize import int8_codes, int8_scores, binary_codes, hamming_scores
+
+# Bump when feature extraction changes so stale stores are rebuilt
+FEATURE_STORE_VERSION = 1
+
+# Rows are prepared, encoded and scored in blocks of about this many bytes,
+# so temporaries stay small even for 32k-dim colour histograms
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# Rows sampled to train the ANN partitions, at most INDEX_TRAIN_BYTES of them
+INDEX_TRAIN_SAMPLE = 8192
+INDEX_TRAIN_BYTES = 64 * 1024 * 1024
+
+
+def chunk_rows(dims, itemsize=4, chunk_bytes=CHUNK_BYTES):
+    """Rows per block for rows of dims values of itemsize bytes"""
+    return max(1, chunk_bytes // max(1, dims * itemsize))
+
+
+def top_rows(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+def feature_checksum(features, chunk_bytes=16 * 1024 * 1024):
+    """
+    SHA-256 of a feature matrix's bytes. Hashed a block of rows at a time
+    straight from the (possibly memory-mapped) array, without copying it.
+    """
+    digest = hashlib.sha256()
+    if features.size:
+        rows = max(1, chunk_bytes // max(1, features[0].nbytes))
+        for start in range(0, features.shape[0], rows):
+            digest.update(memoryview(np.ascontiguousarray(features[start:start + rows])).cast('B'))
+    return digest.hexdigest()
+
+
+def write_enrolment(enrolment_dir, student_id, name, photo_path, mtime, features):
+    """
+    Hand freshly computed features for one student to the camera service.
+    features maps a feature kind (e.g. 'grey_hist') to its feature array.
+    The file is renamed into place so readers never see a partial write.
+    """
+    os.makedirs(enrolment_dir, exist_ok=True)
+    path = os.path.join(enrolment_dir, f'{student_id}.npz')
+    tmp_path = os.path.join(enrolment_dir, f'.{student_id}.tmp.npz')
+    arrays = {f'feature_{kind}': np.ravel(feature).astype(np.float32) for kind, feature in features.items()}
+    np.savez(tmp_path, student_id=int(student_id), name=str(name), photo_path=str(photo_path),
+             mtime=float(mtime), **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_enrolments(enrolment_dir, log=print):
+    """
+    Collect and remove pending enrolment files written by write_enrolment.
+    Returns a list of dicts with student_id, name, photo_path, mtime and features.
+    """
+    enrolments = []
+    if not os.path.isdir(enrolment_dir):
+        return enrolments
+    for filename in sorted(os.listdir(enrolment_dir)):
+        if not filename.endswith('.npz') or filename.startswith('.'):
+            continue
+        path = os.path.join(enrolment_dir, filename)
+        try:
+            with np.load(path) as data:
+                enrolments.append({
+                    'student_id': int(data['student_id']),
+                    'name': str(data['name']),
+                    'photo_path': str(data['photo_path']),
+                    'mtime': float(data['mtime']),
+                    'features': {key[len('feature_'):]: data[key] for key in data.files if key.startswith('feature_')},
+                })
+        except (OSError, ValueError, KeyError) as e:
+            log(f"Discarding unreadable enrolment {path}: {e}")
+        os.remove(path)
+    return enrolments
+
+
+class GalleryEntry:
+    """Cached reference feature for one student"""
+
+    def __init__(self, student_id, name, photo_path, mtime, feature):
+        self.student_id = student_id
+        self.name = name
+        self.photo_path = photo_path
+        self.mtime = mtime
+        self.feature = feature
+
+
+class FaceGallery:
+    """
+    Reference features for every student with a photo, keyed by student_id.
+    Call refresh() at startup and periodically afterwards; only entries whose
+    photo_path or file mtime changed are decoded again.
+    Features come from a recognizer backend and are packed into one contiguous
+    (students x dims) matrix of normalised rows, so a face is scored against
+    every student with a single matrix product.
+    Once the gallery reaches index_min_size students, matching goes through
+    an IVF index instead; index_probe is its recall-vs-latency knob.
+    With compression 'int8' or 'binary' the scan runs over compact codes and
+    only the best rerank_size rows are re-scored at full precision.
+    """
+
+    def __init__(self, base_dir, recognizer=None, index_min_size=2000, index_probe=8,
+                 compression='none', rerank_size=50, log=print):
+        self.base_dir = base_dir
+        self.recognizer = recognizer or HistogramRecognizer()
+        self.feature_kind = self.recognizer.feature_kind
+        self.index_min_size = index_min_size
+        self.index_probe = index_probe
+        self.compression = compression
+        self.rerank_size = rerank_size
+        self.log = log
+        self.entries = {}
+        self.ids = []
+        self.names = []
+        self.rows = {}
+        self.raw_rows = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.codes = None
+        self.scales = None
+        self.dims = 0
+        self.index = None
+        # Students added, changed or removed since the last rebuild
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resolve_path(self, photo_path):
+        """Resolve a photo_path stored in the database to an absolute path"""
+        if os.path.isabs(photo_path):
+            return photo_path
+        return os.path.join(self.base_dir, photo_path)
+
+    def load_reference(self, abs_photo_path):
+        """Decode a reference photo and compute its feature"""
+        imread_flag = cv2.IMREAD_COLOR if self.recognizer.needs_colour else cv2.IMREAD_GRAYSCALE
+        ref_face = cv2.imread(abs_photo_path, imread_flag)
+        if ref_face is None:
+            return None
+        return self.recognizer.extract(ref_face)
+
+    def refresh(self, conn):
+        """
+        Sync the gallery with the student table.
+        Returns the number of entries that were added, reloaded or removed.
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT student_id, name, photo_path FROM student WHERE photo_path IS NOT NULL")
+        students = cursor.fetchall()
+
+        changed = 0
+        seen = set()
+        for student_id, name, photo_path in students:
+            seen.add(student_id)
+            abs_photo_path = self.resolve_path(photo_path)
+            try:
+                mtime = os.path.getmtime(abs_photo_path)
+            except OSError:
+                if self.entries.pop(student_id, None) is not None:
+                    self.dirty.add(student_id)
+                    changed += 1
+                self.log(f"Warning: Photo file not found for student {student_id}: {abs_photo_path}")
+                continue
+
+            entry = self.entries.get(student_id)
+            if entry and entry.photo_path == photo_path and entry.mtime == mtime:
+                # Unchanged photo - only the name may have been edited
+                if entry.name != name:
+                    entry.name = name
+                    changed += 1
+                continue
+
+            feature = self.load_reference(abs_photo_path)
+            if feature is None:
+                if self.entries.pop(student_id, None) is not None:
+                    self.dirty.add(student_id)
+                    changed += 1
+                self.log(f"Warning: Could not read photo file for student {student_id}: {abs_photo_path}")
+                continue
+
+            self.entries[student_id] = GalleryEntry(student_id, name, photo_path, mtime, feature)
+            self.dirty.add(student_id)
+            changed += 1
+
+        # Drop students that were deleted or lost their photo
+        for student_id in list(self.entries):
+            if student_id not in seen:
+                del self.entries[student_id]
+                self.dirty.add(student_id)
+                changed += 1
+
+        if changed:
+            self.rebuild()
+            self.log(f"Face gallery updated: {changed} changes, {len(self.entries)} students")
+        return changed
+
+    def apply_enrolments(self, enrolments):
+        """
+        Add students from read_enrolments() that carry this gallery's feature kind.
+        Returns the number of students added.
+        """
+        added = 0
+        for enrolment in enrolments:
+            feature = enrolment['features'].get(self.feature_kind)
+            if feature is None:
+                continue
+            self.entries[enrolment['student_id']] = GalleryEntry(
+                enrolment['student_id'], enrolment['name'], enrolment['photo_path'], enrolment['mtime'], feature)
+            self.dirty.add(enrolment['student_id'])
+            added += 1
+        if added:
+            self.rebuild()
+            self.log(f"Hot-added {added} enrolled students, {len(self.entries)} in gallery")
+        return added
+
+    def rebuild(self):
+        """Pack the cached features into the scoring matrix or compact codes"""
+        entries = list(self.entries.values())
+        self.ids = [entry.student_id for entry in entries]
+        self.names = [entry.name for entry in entries]
+        self.rows = {student_id: row for row, student_id in enumerate(self.ids)}
+        # Raw features stay where they are (often memory-mapped from the store)
+        self.raw_rows = [entry.feature for entry in entries]
+        self.matrix = None
+        self.codes = None
+        self.scales = None
+
+        if self.compression == 'none':
+            if entries:
+                self.matrix = self.prepared()
+            else:
+                self.matrix = np.zeros((0, 0), dtype=np.float32)
+        elif entries:
+            # Encode a block at a time so the float32 matrix never exists in full
+            step = chunk_rows(np.size(self.raw_rows[0]))
+            for start in range(0, len(entries), step):
+                end = min(start + step, len(entries))
+                chunk = self.prepared(range(start, end))
+                if self.codes is None:
+                    self.dims = chunk.shape[1]
+                    if self.compression == 'int8':
+                        self.codes = np.empty((len(entries), self.dims), dtype=np.int8)
+                        self.scales = np.empty(len(entries), dtype=np.float32)
+                    else:
+                        self.codes = np.empty((len(entries), binary_codes(chunk[:1]).shape[1]), dtype=np.uint8)
+                if self.compression == 'int8':
+                    self.codes[start:end], self.scales[start:end] = int8_codes(chunk)
+                else:
+                    self.codes[start:end] = binary_codes(chunk)
+        self.update_index()
+
+    def prepared(self, rows=None):
+        """
+        Full-precision normalised rows, taken from the matrix or, when the
+        gallery is compressed, recomputed from the raw features.
+        """
+        if self.matrix is not None:
+            return self.matrix if rows is None else self.matrix[rows]
+        if rows is None:
+            rows = range(len(self.raw_rows))
+        return self.recognizer.prepare([np.ravel(self.raw_rows[row]) for row in rows])
+
+    def approx_scores(self, query, rows=None):
+        """
+        Score a prepared query against every row (or just the given rows),
+        using the compact codes when compression is enabled.
+        """
+        if self.compression == 'none':
+            matrix = self.matrix if rows is None else self.matrix[rows]
+            return matrix @ query
+
+        count = len(self.ids) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        if self.compression == 'binary':
+            query_code = binary_codes(query[None])[0]
+        # Blocks bound the copies made when rows are picked out by index
+        step = chunk_rows(self.codes.shape[1], itemsize=1)
+        for start in range(0, count, step):
+            end = min(start + step, count)
+            chunk = slice(start, end) if rows is None else rows[start:end]
+            if self.compression == 'int8':
+                scores[start:end] = int8_scores(self.codes[chunk], self.scales[chunk], query)
+            else:
+                scores[start:end] = hamming_scores(self.codes[chunk], query_code, self.dims)
+        return scores
+
+    def exact_scores(self, query, rows):
+        """Full-precision scores of a prepared query against the given rows"""
+        return self.prepared(rows) @ query
+
+    def update_index(self):
+        """
+        Keep the IVF index in step with the gallery. Changed students are
+        re-assigned incrementally; the partitions are only retrained when the
+        gallery has doubled or halved since they were trained.
+        """
+        size = len(self.ids)
+        if size < self.index_min_size:
+            self.index = None
+        elif (self.index is None or size > 2 * self.index.trained_size
+                or size < self.index.trained_size // 2):
+            self.index = IVFIndex(n_probe=self.index_probe)
+            # k-means only needs a sample of the gallery, a few rows per partition
+            # at least, and no more than INDEX_TRAIN_BYTES of prepared rows
+            n_lists = int(np.sqrt(size))
+            dims = np.size(self.raw_rows[0])
+            sample_size = min(size, max(4 * n_lists, min(INDEX_TRAIN_SAMPLE,
+                                                         chunk_rows(dims, chunk_bytes=INDEX_TRAIN_BYTES))))
+            sample = np.random.default_rng(0).choice(size, sample_size, replace=False)
+            self.index.train(self.prepared(np.sort(sample)), n_lists=n_lists)
+            self.index.trained_size = size
+            step = chunk_rows(dims)
+            for start in range(0, size, step):
+                end = min(start + step, size)
+                self.index.add(self.ids[start:end], self.prepared(range(start, end)))
+            self.log(f"Trained ANN index with {self.index.n_lists} partitions over {size} students")
+        else:
+            removed = [student_id for student_id in self.dirty if student_id not in self.rows]
+            changed = [student_id for student_id in self.dirty if student_id in self.rows]
+            self.index.remove(removed)
+            if changed:
+                self.index.add(changed, self.prepared([self.rows[student_id] for student_id in changed]))
+        if self.index is not None:
+            self.index.bind(self.rows)
+        self.dirty = set()
+
+    def match(self, feature, top_k=1):
+        """
+        Score one face feature against every student at once.
+        Returns up to top_k (student_id, name, score) tuples, best first.
+        """
+        return self.match_batch([feature], top_k)[0]
+
+    def match_batch(self, features, top_k=1):
+        """
+        Score several face features against every student.
+        Returns one list of up to top_k (student_id, name, score) tuples per face.
+        """
+        if not len(features):
+            return []
+        if not self.ids:
+            return [[] for _ in features]
+        queries = self.recognizer.prepare([np.ravel(feature) for feature in features])
+
+        if self.compression == 'none' and self.index is None:
+            # Exact scan: every face against every student in one matrix product
+            scores = queries @ self.matrix.T
+            top_k = min(top_k, len(self.ids))
+            # argpartition keeps this O(n) for large galleries
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            results = []
+            for row, cols in zip(scores, candidates):
+                cols = cols[np.argsort(-row[cols])]
+                results.append([(self.ids[i], self.names[i], float(row[i])) for i in cols])
+            return results
+
+        # Approximate scan (ANN partitions and/or compact codes), then re-rank
+        # the shortlist with full-precision features when codes were used
+        shortlist = top_k if self.compression == 'none' else max(top_k, self.rerank_size)
+        if self.index is not None:
+            approx = self.index.search(self.approx_scores, queries, shortlist)
+        else:
+            approx = []
+            for query in queries:
+                scores = self.approx_scores(query)
+                rows = top_rows(scores, shortlist)
+                approx.append((rows, scores[rows]))
+
+        results = []
+        for query, (rows, scores) in zip(queries, approx):
+            if self.compression != 'none' and len(rows):
+                scores = self.exact_scores(query, rows)
+                order = top_rows(scores, top_k)
+                rows, scores = rows[order], scores[order]
+            results.append([(self.ids[i], self.names[i], float(score)) for i, score in zip(rows, scores)])
+        return results
+
+    def match_faces(self, face_imgs, top_k=1):
+        """Extract features for a batch of face crops and score them in one pass"""
+        return self.match_batch(self.recognizer.extract_batch(face_imgs), top_k)
+
+    def store_paths(self, store_dir):
+        """Feature matrix and metadata file for this gallery's feature kind"""
+        return (os.path.join(store_dir, f'{self.feature_kind}.npy'),
+                os.path.join(store_dir, f'{self.feature_kind}.json'))
+
+    def index_path(self, store_dir):
+        """ANN index file stored alongside the feature matrix"""
+        return os.path.join(store_dir, f'{self.feature_kind}.ivf.npz')
+
+    def save(self, store_dir):
+        """
+        Write the raw features to <store_dir>/<kind>.npy with a JSON sidecar
+        holding the version, checksum and per-student photo_path/mtime.
+        Both files are replaced atomically; the sidecar is written last.
+        With compression on, entries are then switched to the mapped rows,
+        so features decoded since the last save don't stay in memory.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        npy_path, meta_path = self.store_paths(store_dir)
+        entries = list(self.entries.values())
+        shape = (len(entries), np.size(entries[0].feature)) if entries else (0, 0)
+
+        # Rows are written one at a time into the mapped file, never stacked in memory
+        tmp_npy = npy_path + '.tmp.npy'
+        features = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.float32, shape=shape)
+        for row, entry in enumerate(entries):
+            features[row] = np.ravel(entry.feature)
+        features.flush()
+
+        metadata = {
+            'version': FEATURE_STORE_VERSION,
+            'feature_kind': self.feature_kind,
+            'shape': list(shape),
+            'checksum': feature_checksum(features),
+            'students': [[entry.student_id, entry.name, entry.photo_path, entry.mtime] for entry in entries],
+        }
+        del features
+
+        os.replace(tmp_npy, npy_path)
+        tmp_meta = meta_path + '.tmp'
+        with open(tmp_meta, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_meta, meta_path)
+
+        if self.compression != 'none' and entries:
+            mapped = np.load(npy_path, mmap_mode='r')
+            for row, entry in enumerate(entries):
+                entry.feature = mapped[row]
+            if len(self.raw_rows) == len(entries):
+                self.raw_rows = [entry.feature for entry in entries]
+
+        # Persist the ANN partitions so a restart doesn't re-run k-means
+        index_path = self.index_path(store_dir)
+        if self.index is not None:
+            self.index.save(index_path)
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+
+    def load(self, store_dir):
+        """
+        Memory-map a previously saved feature store into the gallery.
+        Returns False (leaving the gallery empty) if the store is missing,
+        from another version or fails its checksum.
+        """
+        npy_path, meta_path = self.store_paths(store_dir)
+        try:
+            with open(meta_path) as f:
+                metadata = json.load(f)
+            if metadata.get('version') != FEATURE_STORE_VERSION or metadata.get('feature_kind') != self.feature_kind:
+                self.log(f"Feature store {meta_path} is out of date, rebuilding")
+                return False
+
+            features = np.load(npy_path, mmap_mode='r')
+            if list(features.shape) != metadata['shape'] or len(metadata['students']) != features.shape[0]:
+                self.log(f"Feature store {npy_path} does not match its metadata, rebuilding")
+                return False
+            if feature_checksum(features) != metadata['checksum']:
+                self.log(f"Feature store {npy_path} failed checksum, rebuilding")
+                return False
+        except (OSError, ValueError, KeyError) as e:
+            self.log(f"No usable feature store at {store_dir}: {e}")
+            return False
+
+        self.entries = {}
+        for row, (student_id, name, photo_path, mtime) in enumerate(metadata['students']):
+            self.entries[student_id] = GalleryEntry(student_id, name, photo_path, mtime, features[row])
+
+        # Reuse the saved ANN partitions if they cover exactly these students
+        index = IVFIndex.load(self.index_path(store_dir), n_probe=self.index_probe)
+        if index is not None and set(index.assignments) == set(self.entries):
+            self.index = index
+        else:
+            self.index = None
+        self.dirty = set()
+        self.rebuild()
+        self.log(f"Loaded {len(self.entries)} reference features from {npy_path}")
+        return True
+
+
+class CascadeGallery:
+    """
+    Two-stage matcher: a cheap coarse gallery (grey histograms) narrows every
+    face down to its top candidates, and only those candidates are re-scored
+    with the expensive fine gallery (embeddings).
+    Faces with no plausible coarse candidate never reach the embedding model.
+    Exposes the same refresh/load/save/apply_enrolments/match_faces calls as
+    FaceGallery so the camera service can use either.
+    """
+
+    def __init__(self, coarse, fine, candidates=5, coarse_floor=0.2, log=print):
+        self.coarse = coarse
+        self.fine = fine
+        self.candidates = candidates
+        self.coarse_floor = coarse_floor
+        self.log = log
+
+    @property
+    def recognizer(self):
+        # Thresholds and crop colour come from the stage that decides the match
+        return self.fine.recognizer
+
+    def __len__(self):
+        return len(self.fine)
+
+    def refresh(self, conn):
+        return self.coarse.refresh(conn) + self.fine.refresh(conn)
+
+    def load(self, store_dir):
+        coarse_loaded = self.coarse.load(store_dir)
+        fine_loaded = self.fine.load(store_dir)
+        return coarse_loaded and fine_loaded
+
+    def save(self, store_dir):
+        self.coarse.save(store_dir)
+        self.fine.save(store_dir)
+
+    def apply_enrolments(self, enrolments):
+        return self.coarse.apply_enrolments(enrolments) + self.fine.apply_enrolments(enrolments)
+
+    def match_faces(self, face_imgs, top_k=1):
+        """
+        Score a batch of face crops: histogram top-K first, then embeddings
+        for the surviving candidates only. Returns one list of up to top_k
+        (student_id, name, score) tuples per face, scored by the fine stage.
+        """
+        results = [[] for _ in face_imgs]
+        shortlists = self.coarse.match_faces(face_imgs, top_k=self.candidates)
+
+        # Only faces whose best histogram candidate is plausible are embedded
+        keep = [i for i, shortlist in enumerate(shortlists)
+                if shortlist and shortlist[0][2] >= self.coarse_floor]
+        if not keep or not self.fine.ids:
+            return results
+
+        queries = self.fine.recognizer.prepare(self.fine.recognizer.extract_batch([face_imgs[i] for i in keep]))
+        for query, i in zip(queries, keep):
+            rows = [self.fine.rows[student_id] for student_id, name, score in shortlists[i]
+                    if student_id in self.fine.rows]
+            if not rows:
+                continue
+            scores = self.fine.exact_scores(query, rows)
+            order = np.argsort(-scores)[:top_k]
+            results[i] = [(self.fine.ids[rows[j]], self.fine.names[rows[j]], float(scores[j])) for j in order]
+        return results
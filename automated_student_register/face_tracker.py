@@ -0,0 +1,190 @@
+"""
+Lightweight multi-face tracker for the camera service.
+Detections are associated with existing tracks by box overlap (IoU), falling
+back to centroid distance for faces that moved between detection ticks, so
+recognition only has to run when a new person appears or a track is due for
+re-verification. Recognition scores are accumulated per track so attendance
+is committed once, after the evidence has stabilised.
+"""
+from collections import deque
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Pairwise intersection-over-union of two lists of (x, y, w, h) boxes"""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.clip(np.minimum(ax2[:, None], bx2[None]) - np.maximum(a[:, 0][:, None], b[:, 0][None]), 0, None)
+    ih = np.clip(np.minimum(ay2[:, None], by2[None]) - np.maximum(a[:, 1][:, None], b[:, 1][None]), 0, None)
+    inter = iw * ih
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+class Track:
+    """One face followed across frames"""
+
+    def __init__(self, track_id, box, now, window_size):
+        self.track_id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.first_seen = now
+        self.last_seen = now
+        self.hits = 1
+        self.last_recognized = None
+        # Set while a recognition job for this track is queued
+        self.pending = False
+        # Recognition samples taken in the current burst
+        self.burst = 0
+        # Sliding window of per-frame results: (top student_id or None, {student_id: score})
+        self.window = deque(maxlen=window_size)
+        # Summed scores per candidate over the whole life of the track
+        self.evidence = {}
+        self.candidate_names = {}
+        # Identity committed once the evidence stabilised
+        self.student_id = None
+        self.name = None
+        self.score = 0.0
+
+    def leader(self):
+        """
+        Candidate with the highest summed score in the window.
+        Returns (student_id, frames as top match, mean score) or None.
+        """
+        sums = {}
+        for top_id, votes in self.window:
+            for student_id, score in votes.items():
+                sums[student_id] = sums.get(student_id, 0.0) + score
+        if not sums:
+            return None
+        student_id = max(sums, key=sums.get)
+        top_frames = sum(1 for top_id, votes in self.window if top_id == student_id)
+        return student_id, top_frames, sums[student_id] / len(self.window)
+
+
+class FaceTracker:
+    """
+    Assigns stable track IDs to detected faces.
+    Tracks that go unmatched for longer than max_age seconds expire.
+
+    Recognition scores are accumulated per track over a sliding window of
+    window_size samples. A student is committed to the track once they were
+    the top match in at least min_hits of those samples, so a single lucky
+    frame never writes attendance.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=2.0, reverify_interval=10.0,
+                 window_size=5, min_hits=3, vote_threshold=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.reverify_interval = reverify_interval
+        self.window_size = window_size
+        self.min_hits = min_hits
+        self.vote_threshold = vote_threshold
+        self.tracks = []
+        self.next_id = 1
+
+    def update(self, boxes, now):
+        """
+        Associate this tick's detections with tracks.
+        Returns the track for each box, in the same order as boxes.
+        """
+        boxes = [tuple(int(v) for v in box) for box in boxes]
+        assigned = [None] * len(boxes)
+
+        if self.tracks and boxes:
+            overlap = iou_matrix([track.box for track in self.tracks], boxes)
+
+            # Centroid distance relative to face size covers faces that moved
+            # too far between ticks to overlap their previous box
+            track_centres = np.array([(x + w / 2, y + h / 2, max(w, h)) for x, y, w, h in
+                                      (track.box for track in self.tracks)], dtype=np.float32)
+            box_centres = np.array([(x + w / 2, y + h / 2) for x, y, w, h in boxes], dtype=np.float32)
+            distance = np.linalg.norm(track_centres[:, None, :2] - box_centres[None], axis=2)
+            close = distance < 0.5 * track_centres[:, 2:3]
+            affinity = np.where(overlap >= self.iou_threshold, overlap, np.where(close, 1e-3, 0))
+
+            # Greedy assignment, best pairs first
+            used_tracks = set()
+            for flat in np.argsort(-affinity, axis=None):
+                t, b = np.unravel_index(flat, affinity.shape)
+                if affinity[t, b] <= 0:
+                    break
+                if t in used_tracks or assigned[b] is not None:
+                    continue
+                track = self.tracks[t]
+                track.box = boxes[b]
+                track.last_seen = now
+                track.hits += 1
+                assigned[b] = track
+                used_tracks.add(t)
+
+        # Unmatched detections start new tracks
+        for b, box in enumerate(boxes):
+            if assigned[b] is None:
+                track = Track(self.next_id, box, now, self.window_size)
+                self.next_id += 1
+                self.tracks.append(track)
+                assigned[b] = track
+
+        # Expire tracks that have not been seen recently
+        self.tracks = [track for track in self.tracks if now - track.last_seen <= self.max_age]
+        return assigned
+
+    def hold(self, now, regions=None):
+        """
+        Keep tracks alive on ticks where detection was skipped because the
+        scene did not change. With regions, only tracks outside every changed
+        (x, y, w, h) region are held; those inside must be re-detected.
+        """
+        for track in self.tracks:
+            if regions is None or not len(regions) or not iou_matrix([track.box], regions).any():
+                track.last_seen = now
+
+    def needs_recognition(self, track, now):
+        """
+        New tracks sample every tick until committed or a full window has been
+        seen; after that they are only re-verified every reverify_interval.
+        """
+        if track.last_recognized is None:
+            return True
+        if track.student_id is None and track.burst < self.window_size:
+            return True
+        return now - track.last_recognized >= self.reverify_interval
+
+    def due_for_recognition(self, tracks, now):
+        """Subset of tracks that should be recognized on this tick and aren't already queued"""
+        return [track for track in tracks if not track.pending and self.needs_recognition(track, now)]
+
+    def add_evidence(self, track, candidates, now):
+        """
+        Fold one recognition result (top-k (student_id, name, score) tuples,
+        best first) into the track.
+        Returns True when this sample commits a new identity to the track.
+        """
+        if track.last_recognized is not None and now - track.last_recognized >= self.reverify_interval:
+            track.burst = 0
+        track.last_recognized = now
+        track.burst += 1
+
+        votes = {}
+        for student_id, name, score in candidates:
+            if score > self.vote_threshold:
+                votes[student_id] = score
+                track.candidate_names[student_id] = name
+                track.evidence[student_id] = track.evidence.get(student_id, 0.0) + score
+        top_id = candidates[0][0] if candidates and candidates[0][0] in votes else None
+        track.window.append((top_id, votes))
+
+        leader = track.leader()
+        if not leader:
+            return False
+        student_id, top_frames, mean_score = leader
+        if top_frames < self.min_hits or student_id == track.student_id:
+            return False
+
+        track.student_id = student_id
+        track.name = track.candidate_names[student_id]
+        track.score = mean_score
+        return True
@@ -0,0 +1,353 @@
+"""
+Shared-memory ring buffer of raw frames from camera_service.py to the web app.
+Replaces the static/current/frame.jpg handoff: the camera service copies each
+published BGR frame and its metadata (frame id, timestamp, detections) into
+one of a few slots, and readers copy the newest complete slot out, with no
+JPEG encode/decode and no disk writes in between. A slot can also carry the
+frame already encoded as a stream-ready JPEG, which the web app forwards
+unchanged to viewers of that stream profile.
+
+Each slot is guarded by a sequence counter (a seqlock): the writer makes it
+odd before touching the slot and even again afterwards, and a reader retries
+if the counter was odd or changed while it copied, so it never sees a
+half-written frame. With several slots a reader copying the newest frame is
+almost never overtaken by the writer.
+
+Readers that want to block until the next frame bind a Unix datagram socket
+in the ring's notify directory; the writer sends each of them a tiny datagram
+per published frame, so waiting costs no polling wakeups.
+"""
+import os
+import json
+import time
+import select
+import socket
+import tempfile
+import cv2
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+RING_NAME = 'fyp_camera_frames'
+RING_MAGIC = 0x46595032  # 'FYP2'
+
+# Header: magic, slots, height, width, channels, meta_size, latest slot, published count,
+# jpeg_size, and the JPEG stream profile (width, height, quality)
+HEADER_FIELDS = 12
+HEADER_BYTES = HEADER_FIELDS * 8
+# Slot header: sequence, frame id, timestamp (float64 bits), metadata length, JPEG length
+SLOT_FIELDS = 5
+SLOT_HEADER_BYTES = SLOT_FIELDS * 8
+
+
+def slot_bytes(shape, meta_size, jpeg_size):
+    return SLOT_HEADER_BYTES + meta_size + jpeg_size + int(np.prod(shape))
+
+
+def notify_dir(name):
+    """Directory holding the sockets of readers waiting on ring name"""
+    return os.path.join(tempfile.gettempdir(), f'{name}.notify')
+
+
+class FrameRingWriter:
+    """Owned by the camera service; creates (or replaces) the shared block"""
+
+    def __init__(self, shape, slots=4, meta_size=16384, jpeg_size=0, jpeg_profile=(0, 0, 0), name=RING_NAME):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.meta_size = meta_size
+        # Room for one encoded JPEG per slot, and the (width, height, quality) it is encoded at
+        self.jpeg_size = jpeg_size
+        self.jpeg_profile = tuple(jpeg_profile)
+        size = HEADER_BYTES + slots * slot_bytes(self.shape, meta_size, jpeg_size)
+        try:
+            # Left behind by a service that didn't shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.header = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=self.block.buf)
+        self.slot_views = [self.view(i) for i in range(slots)]
+        self.header[:] = [RING_MAGIC, slots, self.shape[0], self.shape[1], self.shape[2], meta_size, -1, 0,
+                          jpeg_size] + list(self.jpeg_profile)
+
+        # Wakes readers blocked in FrameRingReader.wait()
+        self.notify_dir = notify_dir(name)
+        self.listeners = []
+        self.last_scan = 0
+        self.notifier = None
+        try:
+            os.makedirs(self.notify_dir, exist_ok=True)
+            self.notifier = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.notifier.setblocking(False)
+        except (OSError, AttributeError):
+            pass  # No Unix sockets here; readers fall back to polling
+
+    def view(self, index):
+        offset = HEADER_BYTES + index * slot_bytes(self.shape, self.meta_size, self.jpeg_size)
+        fields = np.ndarray(SLOT_FIELDS, dtype=np.int64, buffer=self.block.buf, offset=offset)
+        offset += SLOT_HEADER_BYTES
+        meta = np.ndarray(self.meta_size, dtype=np.uint8, buffer=self.block.buf, offset=offset)
+        offset += self.meta_size
+        jpeg = np.ndarray(self.jpeg_size, dtype=np.uint8, buffer=self.block.buf, offset=offset)
+        offset += self.jpeg_size
+        pixels = np.ndarray(self.shape, dtype=np.uint8, buffer=self.block.buf, offset=offset)
+        return fields, meta, jpeg, pixels
+
+    def write(self, frame, frame_id, timestamp, meta=None, jpeg=None):
+        """
+        Publish a BGR frame (resized to the ring's shape if needed) with JSON
+        metadata and, optionally, its stream-profile JPEG encoding
+        """
+        if frame.shape != self.shape:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+        payload = json.dumps(meta or {}).encode('utf-8')
+        if len(payload) > self.meta_size:
+            payload = json.dumps({'truncated': True}).encode('utf-8')
+        jpeg = np.frombuffer(jpeg, dtype=np.uint8) if jpeg is not None else None
+        if jpeg is not None and len(jpeg) > self.jpeg_size:
+            jpeg = None  # Readers encode this frame themselves
+
+        index = (int(self.header[7]) + 1) % self.slots
+        fields, meta_view, jpeg_view, pixels = self.slot_views[index]
+        fields[0] += 1  # Odd: slot is being written
+        pixels[:] = frame
+        meta_view[:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+        if jpeg is not None:
+            jpeg_view[:len(jpeg)] = jpeg
+        fields[1] = frame_id
+        fields[2] = np.float64(timestamp).view(np.int64)
+        fields[3] = len(payload)
+        fields[4] = len(jpeg) if jpeg is not None else 0
+        fields[0] += 1  # Even: slot is complete
+        self.header[6] = index
+        self.header[7] += 1
+        self.notify(int(self.header[7]))
+
+    def notify(self, published):
+        """Send every waiting reader the new published count"""
+        if self.notifier is None:
+            return
+        now = time.time()
+        if now - self.last_scan >= 1.0:
+            # Readers come and go; look for new sockets once a second
+            self.last_scan = now
+            try:
+                self.listeners = [os.path.join(self.notify_dir, entry) for entry in os.listdir(self.notify_dir)]
+            except OSError:
+                self.listeners = []
+        payload = str(published).encode('ascii')
+        for path in list(self.listeners):
+            try:
+                self.notifier.sendto(payload, path)
+            except BlockingIOError:
+                pass  # The reader's queue is full - it has wakeups pending anyway
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a reader that exited
+                self.listeners.remove(path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        self.header = None
+        self.slot_views = []
+        self.block.close()
+        self.block.unlink()
+        if self.notifier is not None:
+            self.notifier.close()
+
+
+class FrameRingReader:
+    """
+    Read side, used by the web app. Attaches lazily and re-attaches when the
+    camera service restarts (its old block then stops updating).
+    """
+
+    def __init__(self, name=RING_NAME, stale_after=3.0):
+        self.name = name
+        self.stale_after = stale_after
+        self.block = None
+        self.last_attach = 0
+        # Socket the writer notifies, bound on the first wait()
+        self.listener = None
+        self.listener_path = None
+
+    def attach(self):
+        """Map the block without registering it with the resource tracker - the writer owns it"""
+        try:
+            try:
+                block = shared_memory.SharedMemory(name=self.name, track=False)
+            except TypeError:
+                register = resource_tracker.register
+                resource_tracker.register = lambda *args, **kwargs: None
+                try:
+                    block = shared_memory.SharedMemory(name=self.name)
+                finally:
+                    resource_tracker.register = register
+        except FileNotFoundError:
+            return False
+        header = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=block.buf)
+        if header[0] != RING_MAGIC:
+            del header  # Views must be released before the mapping is closed
+            block.close()
+            return False
+        self.block = block
+        self.header = header
+        self.slots = int(header[1])
+        self.shape = (int(header[2]), int(header[3]), int(header[4]))
+        self.meta_size = int(header[5])
+        self.jpeg_size = int(header[8])
+        self.jpeg_profile = (int(header[9]), int(header[10]), int(header[11]))
+        return True
+
+    def detach(self):
+        if self.block is not None:
+            self.header = None
+            self.block.close()
+            self.block = None
+
+    def reattach(self):
+        """Drop the current block and look for the service's block again on the next call"""
+        self.detach()
+        self.last_attach = 0
+
+    def available(self):
+        """True if a camera service ring exists (attaching if needed)"""
+        if self.block is None:
+            # Don't hammer shm_open while the service is stopped
+            if time.time() - self.last_attach < 1.0:
+                return False
+            self.last_attach = time.time()
+            return self.attach()
+        return True
+
+    def published(self):
+        """Number of frames published so far, or -1 if there is no ring"""
+        if not self.available():
+            return -1
+        return int(self.header[7])
+
+    def listen(self):
+        """Bind this reader's notification socket, or return None if that isn't possible"""
+        if self.listener is None:
+            path = os.path.join(notify_dir(self.name), f'{os.getpid()}-{id(self)}.sock')
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if os.path.exists(path):
+                    os.unlink(path)
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                listener.bind(path)
+                listener.setblocking(False)
+            except (OSError, AttributeError):
+                return None
+            self.listener, self.listener_path = listener, path
+        return self.listener
+
+    def drain(self):
+        """Discard queued notifications; True if there were any"""
+        notified = False
+        while True:
+            try:
+                self.listener.recv(64)
+                notified = True
+            except BlockingIOError:
+                return notified
+
+    def wait(self, published, timeout=1.0):
+        """
+        Block until a frame after the published count given has been
+        published, or timeout seconds pass. Returns the current published
+        count (-1 if there is no ring).
+        """
+        listener = self.listen()
+        if listener is None:
+            # Nothing will wake us; poll at the old frame-file rate
+            current = self.published()
+            if current == published:
+                time.sleep(min(timeout, 0.1))
+                current = self.published()
+            return current
+
+        # The socket is bound before checking, so a frame published in
+        # between still leaves a datagram queued for select()
+        self.drain()
+        current = self.published()
+        if current != published:
+            return current
+        ready, _, _ = select.select([listener], [], [], timeout)
+        if ready and self.drain():
+            if self.block is None:
+                self.last_attach = 0  # The service just started; attach now
+            current = self.published()
+            if current == published:
+                # Notified by a restarted service, which made a new block
+                self.reattach()
+                current = self.published()
+        return current
+
+    def close(self):
+        self.detach()
+        if self.listener is not None:
+            self.listener.close()
+            try:
+                os.unlink(self.listener_path)
+            except OSError:
+                pass
+            self.listener = None
+
+    def read(self, want_frame=True, want_jpeg=False, retries=5):
+        """
+        Copy of the newest complete frame as (frame, info), where info has
+        frame_id, timestamp, published, the metadata dict and - with want_jpeg -
+        the stream JPEG bytes (or None) and the jpeg_profile they were encoded
+        at. frame is None unless want_frame. Returns (None, None) if there is no
+        ring, nothing was published yet or the frames are older than
+        stale_after seconds.
+        """
+        if not self.available():
+            return None, None
+
+        for _ in range(retries):
+            index = int(self.header[6])
+            if index < 0:
+                return None, None
+            published = int(self.header[7])
+            offset = HEADER_BYTES + index * slot_bytes(self.shape, self.meta_size, self.jpeg_size)
+            fields = np.ndarray(SLOT_FIELDS, dtype=np.int64, buffer=self.block.buf, offset=offset)
+
+            sequence = int(fields[0])
+            if sequence % 2:
+                continue
+            frame_id, stamp, meta_len, jpeg_len = (int(v) for v in fields[1:5])
+            meta_start = offset + SLOT_HEADER_BYTES
+            jpeg_start = meta_start + self.meta_size
+            meta = bytes(self.block.buf[meta_start:meta_start + meta_len])
+            jpeg = bytes(self.block.buf[jpeg_start:jpeg_start + jpeg_len]) if want_jpeg and jpeg_len else None
+            pixels = None
+            if want_frame:
+                pixels = np.ndarray(self.shape, dtype=np.uint8, buffer=self.block.buf,
+                                    offset=jpeg_start + self.jpeg_size).copy()
+            if int(fields[0]) != sequence:
+                continue  # Overwritten while we copied
+
+            del fields  # Views must be released before the mapping can be closed
+            timestamp = float(np.int64(stamp).view(np.float64))
+            if time.time() - timestamp > self.stale_after:
+                # The service stopped, or restarted with a new block
+                self.detach()
+                return None, None
+            try:
+                metadata = json.loads(meta.decode('utf-8')) if meta else {}
+            except ValueError:
+                metadata = {}
+            info = {'frame_id': frame_id, 'timestamp': timestamp, 'published': published, 'meta': metadata}
+            if want_jpeg:
+                info['jpeg'] = jpeg
+                info['jpeg_profile'] = self.jpeg_profile
+            return pixels, info
+        return None, None
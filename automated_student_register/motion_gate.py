@@ -0,0 +1,104 @@
+"""
+Cheap change detection that gates face detection in the camera service.
+Frames are compared against a running-average background on a small
+downscaled copy, so an empty room or a still lecture costs one resize and
+one absdiff per tick instead of a full-resolution cascade pass.
+"""
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Decides whether a frame has changed enough to be worth running the face
+    detector on, and where.
+
+    check() returns (run, regions):
+      (False, [])      - scene is static, skip detection
+      (True, regions)  - detect only inside these (x, y, w, h) full-resolution boxes
+      (True, None)     - detect on the whole frame (first frame, large change or
+                         the periodic refresh)
+    """
+
+    def __init__(self, width=160, pixel_threshold=25, motion_fraction=0.002,
+                 full_frame_fraction=0.25, refresh_interval=5.0, learning_rate=0.05,
+                 padding=0.5):
+        self.width = width
+        # Minimum grey-level change for a downscaled pixel to count as moved
+        self.pixel_threshold = pixel_threshold
+        # Fraction of changed pixels needed to run detection at all
+        self.motion_fraction = motion_fraction
+        # Above this fraction, detecting on the whole frame is cheaper than many regions
+        self.full_frame_fraction = full_frame_fraction
+        # Run a full detection at least this often even in a static scene
+        self.refresh_interval = refresh_interval
+        self.learning_rate = learning_rate
+        # Grow each changed region by this fraction of its size so whole faces fit
+        self.padding = padding
+        self.background = None
+        self.last_full = None
+        self.last_fraction = 0.0
+
+    def reset(self):
+        """Forget the background, e.g. after the camera was moved"""
+        self.background = None
+        self.last_full = None
+
+    def check(self, gray, now):
+        """Compare a grayscale frame with the background and decide what to detect"""
+        frame_h, frame_w = gray.shape[:2]
+        scale = frame_w / float(self.width)
+        small = cv2.resize(gray, (self.width, max(1, int(round(frame_h / scale)))),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+
+        if self.background is None:
+            self.background = small.astype(np.float32)
+            self.last_full = now
+            return True, None
+
+        diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(small, self.background, self.learning_rate)
+        _, mask = cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        self.last_fraction = cv2.countNonZero(mask) / float(mask.size)
+
+        if now - self.last_full >= self.refresh_interval or self.last_fraction >= self.full_frame_fraction:
+            self.last_full = now
+            return True, None
+        if self.last_fraction < self.motion_fraction:
+            return False, []
+
+        regions = []
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            pad_x, pad_y = int(w * self.padding) + 2, int(h * self.padding) + 2
+            x0 = max(0, int((x - pad_x) * scale))
+            y0 = max(0, int((y - pad_y) * scale))
+            x1 = min(frame_w, int((x + w + pad_x) * scale))
+            y1 = min(frame_h, int((y + h + pad_y) * scale))
+            regions.append((x0, y0, x1 - x0, y1 - y0))
+        return True, merge_regions(regions)
+
+
+def merge_regions(regions):
+    """Merge overlapping (x, y, w, h) boxes so no pixel is searched twice"""
+    merged = [list(r) for r in regions]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                ax, ay, aw, ah = merged[i]
+                bx, by, bw, bh = merged[j]
+                if ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah:
+                    x0, y0 = min(ax, bx), min(ay, by)
+                    x1, y1 = max(ax + aw, bx + bw), max(ay + ah, by + bh)
+                    merged[i] = [x0, y0, x1 - x0, y1 - y0]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return [tuple(r) for r in merged]
@@ -0,0 +1,129 @@
+"""
+Staged processing pipeline for the camera service.
+Each stage runs on its own thread and hands work to the next through a small
+bounded queue. When a consumer falls behind, the oldest queued item is
+dropped rather than blocking the producer, so a slow recognition never stalls
+capture - the frame it would have delayed is simply stale by then.
+OpenCV, NumPy and the TFLite interpreter release the GIL in their heavy
+calls, so the stages run in parallel across the Pi's cores.
+"""
+import time
+import threading
+from collections import deque
+
+
+class DropOldestQueue:
+    """Bounded FIFO where put() never blocks: a full queue discards its oldest item"""
+
+    def __init__(self, maxsize, on_drop=None):
+        self.maxsize = maxsize
+        # Called with each discarded item, so producers can undo bookkeeping
+        self.on_drop = on_drop
+        self.items = deque()
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        if dropped is not None and self.on_drop:
+            self.on_drop(dropped)
+
+    def get(self, timeout=None):
+        """Oldest item, or None if nothing arrived within timeout"""
+        with self.condition:
+            if not self.items:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+
+class Stage(threading.Thread):
+    """
+    Runs handler(item) for every item on its input queue, or handler() in a
+    loop for a source stage with no input. Handlers push their own results to
+    downstream queues. Exceptions are logged and the stage keeps running.
+    """
+
+    def __init__(self, name, handler, inbox=None, log=print):
+        super().__init__(name=name, daemon=True)
+        self.handler = handler
+        self.inbox = inbox
+        self.log = log
+        self.stopping = threading.Event()
+        self.processed = 0
+        self.busy = 0.0
+        self.last_ms = 0.0
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            item = None
+            if self.inbox is not None:
+                item = self.inbox.get(timeout=0.5)
+                if item is None:
+                    continue
+            start = time.perf_counter()
+            try:
+                if self.inbox is None:
+                    self.handler()
+                else:
+                    self.handler(item)
+            except Exception as e:
+                self.log(f"Error in {self.name} stage: {e}")
+                time.sleep(0.1)
+            self.last_ms = (time.perf_counter() - start) * 1000
+            self.busy += self.last_ms
+            self.processed += 1
+
+
+class Pipeline:
+    """A set of stages started and stopped together, with per-stage statistics"""
+
+    def __init__(self, log=print):
+        self.log = log
+        self.stages = []
+
+    def add(self, name, handler, inbox=None):
+        stage = Stage(name, handler, inbox, log=self.log)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self, timeout=2.0):
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def stats(self):
+        """Queue depth, drops, throughput and timings for every stage"""
+        stats = {}
+        for stage in self.stages:
+            entry = {
+                'processed': stage.processed,
+                'last_ms': round(stage.last_ms, 1),
+                'mean_ms': round(stage.busy / stage.processed, 1) if stage.processed else 0.0,
+                'alive': stage.is_alive(),
+            }
+            if stage.inbox is not None:
+                entry['queue_depth'] = len(stage.inbox)
+                entry['queue_size'] = stage.inbox.maxsize
+                entry['dropped'] = stage.inbox.dropped
+            stats[stage.name] = entry
+        return stats
@@ -0,0 +1,54 @@
+"""
+Compact codes for gallery features.
+int8 codes keep one scale per row (4x smaller than float32); binary codes
+keep only the sign of each dimension, packed 8 per byte (32x smaller), and
+are compared by Hamming distance. Both are used to shortlist candidates that
+are then re-ranked with the full-precision features.
+"""
+import numpy as np
+
+# Number of set bits in every possible byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def int8_codes(rows):
+    """Symmetric per-row int8 quantisation. Returns (codes, scales)"""
+    rows = np.asarray(rows, dtype=np.float32)
+    scales = np.abs(rows).max(axis=1) / 127.0
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def int8_scores(codes, scales, query):
+    """
+    Approximate dot products of int8 rows with a float32 query. einsum casts
+    the codes in small internal buffers, so no float32 copy of them is made.
+    """
+    return np.einsum('ij,j->i', codes, np.asarray(query, dtype=np.float32), dtype=np.float32) * scales
+
+
+def binary_codes(rows):
+    """
+    Sign bits of each (centred/normalised) row, packed into uint8 and padded
+    with zero bytes to a multiple of 8 so rows can be read as uint64 words.
+    """
+    codes = np.packbits(np.asarray(rows) > 0, axis=1)
+    padding = -codes.shape[1] % 8
+    if padding:
+        codes = np.pad(codes, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(codes)
+
+
+def hamming_scores(codes, query_code, dims):
+    """
+    Similarity in [-1, 1] from the Hamming distance between packed codes:
+    1 - 2 * distance / dims, which tracks the cosine of normalised rows.
+    """
+    if hasattr(np, 'bitwise_count'):
+        # NumPy 2 has a native popcount; 64 bits at a time is much faster
+        words = np.bitwise_xor(codes.view(np.uint64), query_code.view(np.uint64))
+        distance = np.bitwise_count(words).sum(axis=1, dtype=np.int32)
+    else:
+        distance = POPCOUNT[np.bitwise_xor(codes, query_code)].sum(axis=1, dtype=np.int32)
+    return 1.0 - 2.0 * distance.astype(np.float32) / dims
@@ -0,0 +1,198 @@
+"""
+Recognition in a pool of worker processes.
+Feature extraction (histograms, the TFLite model) and scoring run outside the
+camera service's process, so they neither compete with the capture and
+detection threads for the GIL nor stop at one core.
+
+The gallery's prepared feature matrix is published once into a shared memory
+block; every worker maps the same block read-only instead of receiving its own
+copy. Each publish creates a new version, so workers switch over between jobs
+and the old block is freed once no job still uses it. Jobs are submitted
+asynchronously and results come back through a callback.
+"""
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from recognizers import (HistogramRecognizer, ColourHistogramRecognizer, TFLiteEmbeddingRecognizer,
+                         create_recognizer)
+
+# Per-process state of a worker: its recognizer and the gallery version it has mapped
+_worker = {}
+
+
+def build_recognizer(feature_kind, base_dir, num_threads=1):
+    """A recognizer producing the given feature kind, built inside a worker"""
+    if feature_kind == TFLiteEmbeddingRecognizer.feature_kind:
+        return create_recognizer('tflite', base_dir, num_threads, log=lambda message: None)
+    if feature_kind == ColourHistogramRecognizer.feature_kind:
+        return ColourHistogramRecognizer()
+    return HistogramRecognizer()
+
+
+def attach(name):
+    """
+    Map an existing shared memory block without registering it with the
+    resource tracker - the parent owns it and unlinks it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 every attach is registered, and the tracker would
+        # unlink the block when the first worker exits
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def init_worker(feature_kind, base_dir, num_threads):
+    _worker['recognizer'] = build_recognizer(feature_kind, base_dir, num_threads)
+    _worker['version'] = None
+
+
+def recognize_in_worker(version, block_name, shape, face_imgs, top_k):
+    """
+    Extract and score a batch of face crops in a worker process.
+    Returns (gallery rows, scores) per face, best first.
+    """
+    if _worker['version'] != version:
+        if _worker.get('block') is not None:
+            _worker['block'].close()
+        _worker['block'] = attach(block_name)
+        _worker['matrix'] = np.ndarray(shape, dtype=np.float32, buffer=_worker['block'].buf)
+        _worker['version'] = version
+
+    recognizer = _worker['recognizer']
+    queries = recognizer.prepare(recognizer.extract_batch(face_imgs))
+    scores = queries @ _worker['matrix'].T
+    top_k = min(top_k, shape[0])
+    results = []
+    for row in scores:
+        rows = np.argpartition(-row, top_k - 1)[:top_k]
+        rows = rows[np.argsort(-row[rows])]
+        results.append((rows.tolist(), row[rows].tolist()))
+    return results
+
+
+class GallerySnapshot:
+    """One published version of the gallery matrix"""
+
+    def __init__(self, version, ids, names, block, shape):
+        self.version = version
+        self.ids = ids
+        self.names = names
+        self.block = block
+        self.shape = shape
+        # Jobs submitted against this version and not finished yet
+        self.in_flight = 0
+
+    def release(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+class RecognitionPool:
+    """
+    Runs FaceGallery.match_faces equivalents in worker processes.
+    At most max_in_flight jobs are queued in the pool; submit() blocks beyond
+    that, so a caller fed by a drop-oldest queue sheds load instead of
+    building an unbounded backlog.
+    """
+
+    def __init__(self, feature_kind, base_dir, workers=3, top_k=3, num_threads=1,
+                 max_in_flight=None, log=print):
+        self.top_k = top_k
+        self.log = log
+        # Workers are started without forking this (multi-threaded) process
+        context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                            initializer=init_worker,
+                                            initargs=(feature_kind, base_dir, num_threads))
+        self.slots = threading.BoundedSemaphore(max_in_flight or workers * 2)
+        self.lock = threading.Lock()
+        self.version = 0
+        self.current = None
+        self.retired = []
+
+    def publish(self, gallery):
+        """Copy the gallery's prepared matrix into a new shared memory block"""
+        matrix = np.ascontiguousarray(gallery.prepared(), dtype=np.float32) if len(gallery) else None
+        block = None
+        if matrix is not None and matrix.size:
+            block = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+            np.ndarray(matrix.shape, dtype=np.float32, buffer=block.buf)[:] = matrix
+
+        with self.lock:
+            self.version += 1
+            snapshot = GallerySnapshot(self.version, list(gallery.ids), list(gallery.names), block,
+                                       matrix.shape if matrix is not None else (0, 0))
+            if self.current is not None:
+                self.retired.append(self.current)
+            self.current = snapshot
+            self.release_retired()
+        self.log(f"Published gallery version {snapshot.version} ({snapshot.shape[0]} students) to recognition workers")
+
+    def release_retired(self):
+        # Called with self.lock held
+        still_used = []
+        for snapshot in self.retired:
+            if snapshot.in_flight:
+                still_used.append(snapshot)
+            else:
+                snapshot.release()
+        self.retired = still_used
+
+    def submit(self, face_imgs, callback):
+        """
+        Recognize a batch of face crops asynchronously. callback receives one
+        list of up to top_k (student_id, name, score) tuples per crop.
+        """
+        # Counted in the same critical section it is read in, so a publish()
+        # can't release the block while this job waits for a slot
+        with self.lock:
+            snapshot = self.current
+            if snapshot is not None and snapshot.block is not None:
+                snapshot.in_flight += 1
+        if snapshot is None or snapshot.block is None:
+            callback([[] for _ in face_imgs])
+            return
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(recognize_in_worker, snapshot.version, snapshot.block.name,
+                                          snapshot.shape, list(face_imgs), self.top_k)
+        except Exception:
+            self.finish(snapshot)
+            raise
+        future.add_done_callback(lambda done: self.deliver(snapshot, face_imgs, done, callback))
+
+    def deliver(self, snapshot, face_imgs, future, callback):
+        try:
+            results = [[(snapshot.ids[row], snapshot.names[row], float(score)) for row, score in zip(rows, scores)]
+                       for rows, scores in future.result()]
+        except Exception as e:
+            self.log(f"Error in recognition worker: {e}")
+            results = [[] for _ in face_imgs]
+        finally:
+            self.finish(snapshot)
+        callback(results)
+
+    def finish(self, snapshot):
+        with self.lock:
+            snapshot.in_flight -= 1
+            self.release_retired()
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            for snapshot in self.retired + ([self.current] if self.current else []):
+                snapshot.release()
+            self.retired = []
+            self.current = None
@@ -0,0 +1,238 @@
+"""
+Face recognition backends for the camera service.
+Every backend turns face crops into feature rows that FaceGallery can score
+with a single dot product: histograms are the cheap default, and the TFLite
+embedding model gives better accuracy where the Pi has the CPU to spare.
+"""
+import os
+import threading
+import cv2
+import numpy as np
+
+try:
+    import tflite_runtime.interpreter as tflite
+except ImportError:
+    tflite = None
+
+# Where app.py has always looked for the embedding model
+MODEL_FILENAME = 'facial_recognition_model.tflite'
+
+
+def grey_histogram(face_img):
+    """Grey-level histogram feature used by recognize_face"""
+    if len(face_img.shape) == 3:
+        face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
+    face_img_resized = cv2.resize(face_img, (100, 100))
+    hist = cv2.calcHist([face_img_resized], [0], None, [256], [0, 256])
+    cv2.normalize(hist, hist, 0, 1, cv2.NORM_MINMAX)
+    return hist
+
+
+def grey_histograms(face_imgs):
+    """
+    Grey-level histograms for a batch of face crops as one (faces x 256) array.
+    Matches grey_histogram row for row, but bins every crop in a single bincount.
+    """
+    if not face_imgs:
+        return np.zeros((0, 256), dtype=np.float32)
+    resized = np.stack([
+        cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img, (100, 100))
+        for img in face_imgs
+    ]).reshape(len(face_imgs), -1)
+    # Offset each crop's pixel values into its own block of 256 bins
+    offsets = (np.arange(len(face_imgs)) * 256)[:, None]
+    hists = np.bincount((resized + offsets).ravel(), minlength=256 * len(face_imgs))
+    hists = hists.reshape(len(face_imgs), 256).astype(np.float32)
+    # Per-row NORM_MINMAX to [0, 1]
+    lo = hists.min(axis=1, keepdims=True)
+    span = hists.max(axis=1, keepdims=True) - lo
+    span[span == 0] = 1
+    return (hists - lo) / span
+
+
+def colour_histogram(face_img):
+    """32x32x32 RGB histogram feature used by recognize_student"""
+    if len(face_img.shape) == 2:
+        face_img = cv2.cvtColor(face_img, cv2.COLOR_GRAY2RGB)
+    face_img_resized = cv2.resize(face_img, (128, 128))
+    hist = cv2.calcHist([face_img_resized], [0, 1, 2], None, [32, 32, 32], [0, 256, 0, 256, 0, 256])
+    cv2.normalize(hist, hist, 0, 1, cv2.NORM_MINMAX)
+    return hist
+
+
+def correlation_rows(features):
+    """
+    Centre and L2-normalise feature rows so that a dot product between two
+    rows equals cv2.compareHist(..., cv2.HISTCMP_CORREL).
+    Flat (zero variance) rows become all zeros and score 0 against anything.
+    """
+    rows = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+    rows = rows - rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(rows / norms, dtype=np.float32)
+
+
+def l2_rows(features):
+    """L2-normalise feature rows so a dot product is their cosine similarity"""
+    rows = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(rows / norms, dtype=np.float32)
+
+
+def find_model_path(base_dir):
+    """First existing location of the TFLite face embedding model, or None"""
+    possible_paths = [
+        MODEL_FILENAME,  # Original path
+        os.path.join('automated_student_register', 'models', MODEL_FILENAME),
+        os.path.join(base_dir, 'models', MODEL_FILENAME),
+        os.path.join(base_dir, MODEL_FILENAME),
+    ]
+    for model_path in possible_paths:
+        if os.path.exists(model_path):
+            return model_path
+    return None
+
+
+class Recognizer:
+    """
+    Interface shared by recognition backends.
+    Images are passed in OpenCV order (BGR or single-channel grey).
+    """
+    # Name used for feature store files and enrolment features
+    feature_kind = None
+    # Whether face crops should be cut from the colour frame rather than grey
+    needs_colour = False
+    # Minimum similarity for a face to count as a match
+    match_threshold = 0.5
+
+    def extract(self, face_img):
+        """Feature vector for one face"""
+        return self.extract_batch([face_img])[0]
+
+    def extract_batch(self, face_imgs):
+        """(faces x dims) feature array for a batch of faces"""
+        raise NotImplementedError
+
+    def prepare(self, features):
+        """Normalise feature rows so that scoring is a plain dot product"""
+        raise NotImplementedError
+
+
+class HistogramRecognizer(Recognizer):
+    """Grey-level histogram correlation, the original recognize_face method"""
+    feature_kind = 'grey_hist'
+
+    def extract(self, face_img):
+        return grey_histogram(face_img).ravel()
+
+    def extract_batch(self, face_imgs):
+        return grey_histograms(face_imgs)
+
+    def prepare(self, features):
+        return correlation_rows(features)
+
+
+class ColourHistogramRecognizer(Recognizer):
+    """32x32x32 RGB histogram correlation used by recognize_student"""
+    feature_kind = 'colour_hist'
+    needs_colour = True
+    match_threshold = 0.4
+
+    def extract_batch(self, face_imgs):
+        if not face_imgs:
+            return np.zeros((0, 32 * 32 * 32), dtype=np.float32)
+        features = []
+        for face_img in face_imgs:
+            if len(face_img.shape) == 3:
+                face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
+            features.append(colour_histogram(face_img).ravel())
+        return np.stack(features)
+
+    def prepare(self, features):
+        return correlation_rows(features)
+
+
+class TFLiteEmbeddingRecognizer(Recognizer):
+    """
+    Face embeddings from facial_recognition_model.tflite.
+    A whole batch of crops goes through a single invoke() by resizing the
+    interpreter's input tensor to the batch size; embeddings are L2-normalised
+    so gallery scores are cosine similarities.
+    """
+    feature_kind = 'tflite_embedding'
+    needs_colour = True
+    match_threshold = 0.6
+
+    def __init__(self, model_path, num_threads=4):
+        if tflite is None:
+            raise RuntimeError("tflite_runtime is not installed")
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        _, self.input_height, self.input_width, self.input_channels = self.input_details['shape']
+        self.batch_size = self.input_details['shape'][0]
+        # The interpreter is not safe to invoke from several threads at once
+        self.lock = threading.Lock()
+
+    def preprocess(self, face_img):
+        """Resize one crop to the model input and convert it to RGB"""
+        if len(face_img.shape) == 2:
+            face_img = cv2.cvtColor(face_img, cv2.COLOR_GRAY2RGB)
+        else:
+            face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
+        face_img = cv2.resize(face_img, (int(self.input_width), int(self.input_height)))
+        if self.input_channels == 1:
+            face_img = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)[:, :, None]
+        return face_img
+
+    def extract_batch(self, face_imgs):
+        if not face_imgs:
+            return np.zeros((0, int(self.output_details['shape'][-1])), dtype=np.float32)
+
+        batch = np.stack([self.preprocess(face_img) for face_img in face_imgs])
+        if self.input_details['dtype'] == np.float32:
+            # Scale pixels to [-1, 1]
+            batch = (batch.astype(np.float32) - 127.5) / 128.0
+        else:
+            batch = batch.astype(self.input_details['dtype'])
+
+        with self.lock:
+            # Only reallocate when the number of faces changes
+            if len(face_imgs) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_details['index'], list(batch.shape))
+                self.interpreter.allocate_tensors()
+                self.input_details = self.interpreter.get_input_details()[0]
+                self.output_details = self.interpreter.get_output_details()[0]
+                self.batch_size = len(face_imgs)
+
+            self.interpreter.set_tensor(self.input_details['index'], batch)
+            self.interpreter.invoke()
+            embeddings = self.interpreter.get_tensor(self.output_details['index'])
+        return l2_rows(embeddings.reshape(len(face_imgs), -1))
+
+    def prepare(self, features):
+        return l2_rows(features)
+
+
+def create_recognizer(backend, base_dir, num_threads=4, log=print):
+    """
+    Build the requested backend ('histogram' or 'tflite').
+    Falls back to histograms if the embedding model can't be loaded.
+    """
+    if backend == 'tflite':
+        model_path = find_model_path(base_dir)
+        if model_path is None:
+            log("Embedding model not found, falling back to histogram recognition")
+        else:
+            try:
+                recognizer = TFLiteEmbeddingRecognizer(model_path, num_threads=num_threads)
+                log(f"Loaded embedding model from {model_path} with {num_threads} threads")
+                return recognizer
+            except Exception as e:
+                log(f"Error loading embedding model: {e}, falling back to histogram recognition")
+    return HistogramRecognizer()
@@ -0,0 +1,231 @@
+"""
+Encode-once MJPEG broadcasting for the web app.
+One producer thread reads each new camera frame once, encodes it once per
+stream profile that has viewers, and every viewer of that profile is sent the
+same bytes. Extra viewers cost a socket write, not another decode, resize and
+JPEG encode. The producer only runs while someone is watching.
+
+Profiles are registered by name (video, capture, thumbnail, ...) but encoded
+per variant, keyed by (size, quality, overlay): names that describe the same
+variant share one encoding, and a variant nobody is watching is never encoded.
+
+When the camera service has already encoded a frame at a profile's size and
+quality, that profile forwards the service's bytes unchanged and the frame is
+not even copied out of shared memory; only the other profiles re-encode.
+"""
+import time
+import threading
+import cv2
+
+
+class StreamProfile:
+    """How one kind of stream renders a frame: size, JPEG quality and overlay text"""
+
+    def __init__(self, name, size=None, quality=70, overlay=None, max_age=5, placeholder=None,
+                 passthrough=False):
+        self.name = name
+        # Frames larger than (width, height) are scaled down to it
+        self.size = size
+        self.quality = quality
+        self.overlay = overlay
+        # Frames older than this many seconds are replaced by the placeholder
+        self.max_age = max_age
+        # placeholder(service_running) -> BGR image shown when there is no frame
+        self.placeholder = placeholder
+        # Forward JPEGs the camera service encoded at this size and quality
+        self.passthrough = passthrough
+
+    @property
+    def key(self):
+        """The variant this profile encodes; profiles with equal keys share frames"""
+        return (tuple(self.size) if self.size else None, self.quality, self.overlay)
+
+    def fit(self, frame):
+        """The frame scaled down to the profile's size if it is larger"""
+        if self.size and (frame.shape[1] > self.size[0] or frame.shape[0] > self.size[1]):
+            return cv2.resize(frame, tuple(self.size))
+        return frame
+
+    def accepts(self, jpeg_profile):
+        """True if a JPEG encoded at (width, height, quality) can be sent as it is"""
+        return (self.passthrough and not self.overlay and self.size is not None
+                and tuple(jpeg_profile) == (self.size[0], self.size[1], self.quality))
+
+    def render(self, frame):
+        """JPEG bytes for one BGR camera frame"""
+        image = self.fit(frame)
+        if self.overlay:
+            if image is frame:
+                image = frame.copy()  # Don't draw on the caller's frame
+            cv2.putText(image, self.overlay, (20, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 0), 2)
+        ret, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        return buffer.tobytes() if ret else None
+
+
+def multipart_chunk(jpeg_bytes):
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + jpeg_bytes + b'\r\n')
+
+
+class StreamHub:
+    """
+    Fans encoded frames out to every subscriber of a profile.
+    source(last_key, want_frame, want_jpeg) returns (key, timestamp, frame,
+    jpeg) for the newest camera frame, where jpeg is (jpeg_profile, bytes) if
+    the service encoded it; frame and jpeg are None if there is no frame or it
+    is still last_key.
+    wait(seen, timeout), if given, blocks until there is a frame after the
+    token seen and returns the new token; without it the producer polls the
+    source every interval seconds.
+    """
+
+    def __init__(self, source, service_running, wait=None, interval=0.1, placeholder_interval=1.0, log=print):
+        self.source = source
+        self.wait = wait
+        self.service_running = service_running
+        self.interval = interval
+        self.placeholder_interval = placeholder_interval
+        self.log = log
+        # Registry: profile name -> profile, and variant key -> the profile that renders it
+        self.profiles = {}
+        self.variants = {}
+        # Per variant: viewer count, latest (sequence, bytes), and frames
+        # forwarded as the service encoded them vs encoded here
+        self.subscribers = {}
+        self.latest = {}
+        self.forwarded = {}
+        self.encoded = {}
+        self.condition = threading.Condition()
+        self.producer = None
+        # listener(name) is called after every publish, e.g. to wake an event loop
+        self.listeners = []
+
+    def add_profile(self, profile):
+        """
+        Register a profile by name. A profile whose variant is already
+        registered shares that variant's frames; the first profile registered
+        for a variant decides its max_age, placeholder and passthrough.
+        """
+        with self.condition:
+            self.profiles[profile.name] = profile
+            self.variants.setdefault(profile.key, profile)
+            self.subscribers.setdefault(profile.key, 0)
+
+    def has_profile(self, name):
+        return name in self.profiles
+
+    def variant(self, name):
+        return self.profiles[name].key
+
+    def stats(self):
+        with self.condition:
+            stats = {}
+            for name, profile in self.profiles.items():
+                key = profile.key
+                size, quality, overlay = key
+                stats[name] = {'variant': {'size': list(size) if size else None, 'quality': quality,
+                                           'overlay': overlay},
+                               'subscribers': self.subscribers[key],
+                               'frames': self.latest.get(key, (0, None))[0],
+                               'forwarded': self.forwarded.get(key, 0), 'encoded': self.encoded.get(key, 0)}
+            return stats
+
+    def subscribe(self, name):
+        """Count a viewer of a profile, starting the producer if it is the first"""
+        with self.condition:
+            self.subscribers[self.variant(name)] += 1
+            if self.producer is None:
+                self.producer = threading.Thread(target=self.run, name='stream-hub', daemon=True)
+                self.producer.start()
+
+    def unsubscribe(self, name):
+        with self.condition:
+            self.subscribers[self.variant(name)] -= 1
+
+    def frame(self, name):
+        """Latest (sequence, JPEG bytes) of a profile; sequence 0 means none yet"""
+        with self.condition:
+            return self.latest.get(self.variant(name), (0, None))
+
+    def stream(self, name):
+        """Generator of multipart MJPEG chunks for one viewer"""
+        key = self.variant(name)
+        self.subscribe(name)
+        sequence = 0
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.latest.get(key, (0, None))[0] > sequence, timeout=2.0)
+                    sequence, jpeg_bytes = self.latest.get(key, (0, None))
+                if jpeg_bytes:
+                    yield multipart_chunk(jpeg_bytes)
+        finally:
+            # The viewer disconnected
+            self.unsubscribe(name)
+
+    def publish(self, key, jpeg_bytes):
+        if jpeg_bytes is None:
+            return
+        with self.condition:
+            sequence = self.latest.get(key, (0, None))[0] + 1
+            self.latest[key] = (sequence, jpeg_bytes)
+            self.condition.notify_all()
+            names = [name for name, profile in self.profiles.items() if profile.key == key]
+        for listener in self.listeners:
+            for name in names:
+                listener(name)
+
+    def run(self):
+        """Producer: encode each new frame once per watched variant"""
+        last_key = None
+        last_stamp = 0
+        last_placeholder = {}
+        seen = None
+        while True:
+            try:
+                with self.condition:
+                    active = [self.variants[key] for key, count in self.subscribers.items() if count > 0]
+                    if not active:
+                        self.producer = None
+                        return
+
+                now = time.time()
+                # Only copy the raw frame out if some profile has to encode it
+                want_frame = any(not profile.passthrough for profile in active)
+                want_jpeg = any(profile.passthrough for profile in active)
+                key, timestamp, frame, jpeg = self.source(last_key, want_frame, want_jpeg)
+                if frame is None and jpeg is not None and not all(profile.accepts(jpeg[0]) for profile in active):
+                    # The service's JPEG doesn't fit every profile after all
+                    key, timestamp, frame, jpeg = self.source(None, True, True)
+                if frame is not None or jpeg is not None:
+                    last_key, last_stamp = key, timestamp
+                    for profile in active:
+                        if now - timestamp >= profile.max_age:
+                            continue
+                        if jpeg is not None and profile.accepts(jpeg[0]):
+                            self.publish(profile.key, jpeg[1])
+                            self.forwarded[profile.key] = self.forwarded.get(profile.key, 0) + 1
+                        elif frame is not None:
+                            self.publish(profile.key, profile.render(frame))
+                            self.encoded[profile.key] = self.encoded.get(profile.key, 0) + 1
+
+                # Profiles without a recent frame get a status image once a second
+                for profile in active:
+                    if now - last_stamp < profile.max_age or profile.placeholder is None:
+                        continue
+                    if now - last_placeholder.get(profile.key, 0) >= self.placeholder_interval:
+                        last_placeholder[profile.key] = now
+                        image = profile.fit(profile.placeholder(self.service_running()))
+                        ret, buffer = cv2.imencode('.jpg', image)
+                        if ret:
+                            self.publish(profile.key, buffer.tobytes())
+
+                if self.wait:
+                    # Wake for the next frame, or in time for the next placeholder
+                    seen = self.wait(seen, self.placeholder_interval)
+                else:
+                    time.sleep(self.interval)
+            except Exception as e:
+                self.log(f"Error in stream hub: {e}")
+                time.sleep(0.5)
@@ -0,0 +1,178 @@
+"""
+Asyncio MJPEG server for the live camera streams.
+Every viewer of /video_feed or /capture_feed in Flask holds a worker thread
+for as long as the page is open, so a handful of dashboards exhausts the
+server. Here all viewers share one event loop on its own thread and port: a
+viewer costs a socket and a coroutine, not a thread.
+
+Frames come from the StreamHub, so they are still encoded once per profile.
+A client is only ever sent the newest frame once its previous one has been
+flushed to the socket; a slow client skips the frames in between instead of
+having them queue up in memory.
+"""
+import asyncio
+import threading
+from urllib.parse import urlsplit, parse_qs
+from stream_hub import multipart_chunk
+
+MULTIPART_HEADERS = (b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                     b'Cache-Control: no-cache, no-store\r\n'
+                     b'Connection: close\r\n\r\n')
+
+
+def error_response(status, message, headers=()):
+    body = message.encode('utf-8')
+    lines = [f'HTTP/1.1 {status}', 'Content-Type: text/plain; charset=utf-8',
+             f'Content-Length: {len(body)}', 'Connection: close', *headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class MJPEGServer:
+    """
+    Serves the StreamHub's profiles over plain HTTP from one event loop.
+    routes maps a request path to its default profile name, which a
+    ?profile= query parameter may override. At most max_viewers streams are
+    open at once; further requests get 503.
+    """
+
+    def __init__(self, hub, routes, host='127.0.0.1', port=8081, max_viewers=100,
+                 write_timeout=10.0, log=print):
+        self.hub = hub
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self.max_viewers = max_viewers
+        # A client that can't take a frame within this many seconds is dropped
+        self.write_timeout = write_timeout
+        self.log = log
+        self.loop = None
+        self.thread = None
+        # Replaced on every publish; a viewer waits on the one current when it last looked
+        self.events = {}
+        self.viewers = 0
+        self.sent = 0
+        self.skipped = 0
+        self.rejected = 0
+
+    def start(self):
+        """Bind and serve on a background thread. Returns False if the port couldn't be bound."""
+        started = threading.Event()
+        errors = []
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                server = self.loop.run_until_complete(
+                    asyncio.start_server(self.handle, self.host, self.port))
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                self.loop.close()
+                return
+            started.set()
+            try:
+                self.loop.run_until_complete(server.serve_forever())
+            finally:
+                self.loop.close()
+
+        self.thread = threading.Thread(target=serve, name='mjpeg-server', daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            self.log(f"Could not start MJPEG server on {self.host}:{self.port}: {errors[0]}")
+            return False
+        self.hub.listeners.append(self.notify)
+        self.log(f"MJPEG server listening on {self.host}:{self.port}")
+        return True
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self):
+        return {'viewers': self.viewers, 'max_viewers': self.max_viewers, 'sent': self.sent,
+                'skipped': self.skipped, 'rejected': self.rejected}
+
+    def notify(self, name):
+        """Called on the hub's producer thread after it publishes a profile"""
+        if self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.wake, name)
+            except RuntimeError:
+                pass  # The loop is shutting down
+
+    def wake(self, name):
+        event = self.events.get(name)
+        self.events[name] = asyncio.Event()
+        if event is not None:
+            event.set()
+
+    def profile_for(self, target):
+        """Profile name for a request target, or None"""
+        parts = urlsplit(target)
+        name = self.routes.get(parts.path)
+        requested = parse_qs(parts.query).get('profile')
+        if name is not None and requested:
+            name = requested[0]
+        return name if name is not None and self.hub.has_profile(name) else None
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5.0)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                return
+            request_line = head.split(b'\r\n', 1)[0].decode('latin-1').split()
+            if len(request_line) != 3 or request_line[0] != 'GET':
+                writer.write(error_response('405 Method Not Allowed', 'Only GET is supported'))
+                return
+            name = self.profile_for(request_line[1])
+            if name is None:
+                writer.write(error_response('404 Not Found', 'No such stream'))
+                return
+            if self.viewers >= self.max_viewers:
+                self.rejected += 1
+                writer.write(error_response('503 Service Unavailable', 'Too many viewers, try again later',
+                                            ['Retry-After: 10']))
+                return
+            await self.stream(name, writer)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # The viewer went away or stopped reading
+        except Exception as e:
+            self.log(f"Error in MJPEG server: {e}")
+        finally:
+            try:
+                await asyncio.wait_for(writer.drain(), timeout=1.0)
+            except Exception:
+                pass
+            writer.close()
+
+    async def stream(self, name, writer):
+        # drain() then waits until everything is handed to the kernel, so at
+        # most one frame per client is ever buffered here
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(MULTIPART_HEADERS)
+        self.viewers += 1
+        self.hub.subscribe(name)
+        sequence = 0
+        try:
+            while True:
+                # Take the event before looking, so a publish in between isn't missed
+                event = self.events.setdefault(name, asyncio.Event())
+                latest, jpeg_bytes = self.hub.frame(name)
+                if latest == sequence or jpeg_bytes is None:
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout=2.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if sequence:
+                    self.skipped += max(latest - sequence - 1, 0)
+                sequence = latest
+                writer.write(multipart_chunk(jpeg_bytes))
+                await asyncio.wait_for(writer.drain(), timeout=self.write_timeout)
+                self.sent += 1
+        finally:
+            self.viewers -= 1
+            self.hub.unsubscribe(name)
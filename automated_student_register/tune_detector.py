@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Offline tuner for the camera service's face detector.
+Replays recorded frames (a directory of images or a video file) through the
+same detection code the service runs, over a grid of cascade parameters, and
+reports recall against hand-labelled boxes alongside milliseconds per frame
+(a full detection cycle, with the small-face pass over the whole frame).
+The fastest configuration on the recall/latency Pareto front that reaches
+--target-recall is written to a JSON file that camera_service.py loads at
+startup.
+
+Labels are a JSON object mapping each image file name (or, for a video, the
+frame index as a string) to a list of [x, y, w, h] face boxes:
+
+    {"frame_0001.jpg": [[412, 180, 64, 64]], "frame_0002.jpg": []}
+
+Frames without an entry are skipped.
+
+Usage:
+    python tune_detector.py --frames recordings/room_a --labels room_a.json
+    python tune_detector.py --video lecture.mp4 --labels lecture.json --every 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import cv2
+import numpy as np
+from face_detection import PyramidDetector, DETECTOR_CONFIG_FILENAME
+from detectors import load_detector, CASCADE_FILES
+from face_tracker import iou_matrix
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def parse_list(text, cast):
+    return [cast(value) for value in text.split(',') if value.strip()]
+
+
+def read_labels(path):
+    with open(path) as f:
+        labels = json.load(f)
+    return {str(key): [tuple(int(v) for v in box) for box in boxes] for key, boxes in labels.items()}
+
+
+def load_frames(args, labels):
+    """Labelled grayscale frames, in recording order, as (key, image) pairs"""
+    frames = []
+    if args.frames:
+        for filename in sorted(os.listdir(args.frames)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS) and filename in labels:
+                img = cv2.imread(os.path.join(args.frames, filename), cv2.IMREAD_GRAYSCALE)
+                if img is not None:
+                    frames.append((filename, img))
+    else:
+        capture = cv2.VideoCapture(args.video)
+        index = 0
+        while True:
+            ok, img = capture.read()
+            if not ok:
+                break
+            if index % args.every == 0 and str(index) in labels:
+                frames.append((str(index), cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)))
+            index += 1
+        capture.release()
+    return frames
+
+
+def matched_boxes(truth, detected, iou_threshold=0.5):
+    """Number of labelled boxes matched one-to-one by a detection with IoU >= iou_threshold"""
+    if not truth or not len(detected):
+        return 0
+    overlap = iou_matrix(truth, detected)
+    used_truth, used_detected = set(), set()
+    for flat in np.argsort(-overlap, axis=None):
+        t, d = np.unravel_index(flat, overlap.shape)
+        if overlap[t, d] < iou_threshold:
+            break
+        if t in used_truth or d in used_detected:
+            continue
+        used_truth.add(t)
+        used_detected.add(d)
+    return len(used_truth)
+
+
+def evaluate(face_cascade, frames, labels, params, iou_threshold):
+    """
+    Replay every frame through one detector configuration. Labelled frames
+    are independent stills, so the small-face pass covers the whole frame on
+    each one instead of one stripe per call as in the service; timings are
+    for that full cycle.
+    """
+    detector = PyramidDetector(face_cascade, downscale=params['downscale'],
+                               scale_factor=params['scale_factor'],
+                               min_neighbors=params['min_neighbors'],
+                               min_size=(params['min_size'], params['min_size']),
+                               fine_stripes=1)
+    total = matched = detections = 0
+    elapsed = 0.0
+    for key, gray in frames:
+        start = time.perf_counter()
+        faces = detector.detect(gray)
+        elapsed += time.perf_counter() - start
+
+        truth = labels[key]
+        total += len(truth)
+        detections += len(faces)
+        matched += matched_boxes(truth, faces, iou_threshold)
+
+    return {
+        'recall': matched / float(total) if total else 1.0,
+        'false_positives': (detections - matched) / float(len(frames)),
+        'ms_per_frame': elapsed * 1000 / len(frames),
+    }
+
+
+def pareto_front(results):
+    """Configurations no other configuration beats on both recall and speed"""
+    front = []
+    for result in results:
+        dominated = any(other['recall'] >= result['recall'] and other['ms_per_frame'] <= result['ms_per_frame']
+                        and (other['recall'] > result['recall'] or other['ms_per_frame'] < result['ms_per_frame'])
+                        for other in results)
+        if not dominated:
+            front.append(result)
+    return sorted(front, key=lambda r: r['ms_per_frame'])
+
+
+def choose(front, target_recall):
+    """Fastest Pareto configuration meeting the recall target, else the most accurate one"""
+    meeting = [r for r in front if r['recall'] >= target_recall]
+    if meeting:
+        return meeting[0]
+    return max(front, key=lambda r: r['recall'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune face detection parameters on recorded footage")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--frames', help="Directory of recorded frames")
+    source.add_argument('--video', help="Recorded video file")
+    parser.add_argument('--labels', required=True, help="JSON file of labelled face boxes per frame")
+    parser.add_argument('--every', type=int, default=1, help="Use every Nth video frame")
+    parser.add_argument('--backend', default='haar', choices=sorted(CASCADE_FILES) + ['yunet'],
+                        help="Detector backend to tune")
+    parser.add_argument('--scale-factors', default='1.05,1.1,1.2,1.3')
+    parser.add_argument('--min-neighbors', default='3,4,5,6')
+    parser.add_argument('--min-sizes', default='20,30,40,60')
+    parser.add_argument('--downscales', default='1.0,0.5', help="Coarse-pass scales (1.0 is a single full-resolution pass)")
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU for a detection to count as a hit")
+    parser.add_argument('--target-recall', type=float, default=0.9)
+    parser.add_argument('--output', default=os.path.join(BASE_DIR, DETECTOR_CONFIG_FILENAME),
+                        help="Where to write the chosen configuration")
+    args = parser.parse_args()
+
+    labels = read_labels(args.labels)
+    frames = load_frames(args, labels)
+    if not frames:
+        print("No labelled frames found")
+        return 1
+
+    face_cascade = load_detector(args.backend, BASE_DIR)
+    if face_cascade is None:
+        return 1
+
+    grid = itertools.product(parse_list(args.downscales, float), parse_list(args.scale_factors, float),
+                             parse_list(args.min_neighbors, int), parse_list(args.min_sizes, int))
+    print(f"Replaying {len(frames)} frames")
+    print(f"{'downscale':>9} {'scale':>6} {'neigh':>5} {'minsz':>5} {'recall':>7} {'fp/frame':>8} {'ms/frame':>9}")
+
+    results = []
+    for downscale, scale_factor, min_neighbors, min_size in grid:
+        params = {'downscale': downscale, 'scale_factor': scale_factor,
+                  'min_neighbors': min_neighbors, 'min_size': min_size}
+        result = dict(params, **evaluate(face_cascade, frames, labels, params, args.iou))
+        results.append(result)
+        print(f"{downscale:>9.2f} {scale_factor:>6.2f} {min_neighbors:>5} {min_size:>5} "
+              f"{result['recall']:>7.3f} {result['false_positives']:>8.2f} {result['ms_per_frame']:>9.1f}")
+
+    front = pareto_front(results)
+    best = choose(front, args.target_recall)
+
+    print("\nPareto front (fastest first):")
+    for result in front:
+        marker = '*' if result is best else ' '
+        print(f"{marker} downscale={result['downscale']} scale_factor={result['scale_factor']} "
+              f"min_neighbors={result['min_neighbors']} min_size={result['min_size']}: "
+              f"recall {result['recall']:.3f}, {result['ms_per_frame']:.1f} ms/frame")
+
+    config = {key: best[key] for key in ('downscale', 'scale_factor', 'min_neighbors', 'min_size')}
+    config['backend'] = args.backend
+    config['tuned'] = {
+        'source': args.frames or args.video,
+        'frames': len(frames),
+        'recall': round(best['recall'], 4),
+        'ms_per_frame': round(best['ms_per_frame'], 2),
+        'target_recall': args.target_recall,
+        'pareto_front': [{key: round(value, 4) if isinstance(value, float) else value
+                          for key, value in result.items()} for result in front],
+    }
+    tmp_path = args.output + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"\nWrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())